@@ -0,0 +1,31 @@
+import os
+import argparse
+from datasets.image_store import build_image_store
+from datasets.gt_cache import build_gt_cache
+from datasets.dtu_cl import MVSDataset
+
+parser = argparse.ArgumentParser(description="offline caches for DTU training")
+parser.add_argument("--datapath", default="/media/data2/datasets/DTU_Dataset/dtu_training", type=str)
+parser.add_argument("--listfile", type=str, nargs='+', default=["datasets/lists/dtu/train.txt", "datasets/lists/dtu/val.txt"])
+parser.add_argument("--image_store", type=str, default=None, help="defaults to {datapath}/image_store")
+parser.add_argument("--gt_cache", type=str, default=None, help="defaults to {datapath}/gt_cache")
+parser.add_argument("--num_lights", type=int, default=7)
+parser.add_argument("--skip_images", action="store_true")
+parser.add_argument("--skip_gt", action="store_true")
+# only needed to construct the dtu_cl dataset
+parser.set_defaults(img_size=[512, 640], nviews=5, numdepth=192, interval_scale=1.06, gt_cache_size=0)
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    scans = []
+    for listfile in args.listfile:
+        with open(listfile) as f:
+            scans += [line.rstrip() for line in f.readlines() if line.strip()]
+    scans = sorted(set(scans))
+
+    if not args.skip_images:
+        build_image_store(args.datapath, scans, args.image_store or os.path.join(args.datapath, "image_store"), args.num_lights)
+
+    if not args.skip_gt:
+        for listfile in args.listfile:
+            build_gt_cache(MVSDataset(args, listfile, "train"), args.gt_cache or os.path.join(args.datapath, "gt_cache"))
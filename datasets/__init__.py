@@ -5,6 +5,7 @@ from torch.utils.data import RandomSampler, SequentialSampler
 
 from .general_eval import MVSDataset as EvalDataset
 from .dtu_cl import MVSDataset as DtuCLDataset
+from .sampler import LocalitySampler
 
 
 def get_loader(args, listfile, mode="train"):
@@ -15,7 +16,10 @@ def get_loader(args, listfile, mode="train"):
     else:
         raise NotImplementedError("Don't support dataset: {}".format(args.dataset_name))
 
-    if args.distributed:
+    if mode == "train" and args.sampler == "locality":
+        num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if args.distributed else (1, 0)
+        sampler = LocalitySampler(dataset, args.sampler_window, num_replicas=num_replicas, rank=rank)
+    elif args.distributed:
         sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=dist.get_world_size(), rank=dist.get_rank())
     else:
         sampler = RandomSampler(dataset) if (mode == "train") else SequentialSampler(dataset)
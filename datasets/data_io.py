@@ -3,14 +3,7 @@ import re
 import sys
 
 
-def read_pfm(filename):
-    file = open(filename, 'rb')
-    color = None
-    width = None
-    height = None
-    scale = None
-    endian = None
-
+def read_pfm_header(file):
     header = file.readline().decode('utf-8').rstrip()
     if header == 'PF':
         color = True
@@ -32,21 +25,28 @@ def read_pfm(filename):
     else:
         endian = '>'  # big-endian
 
-    data = np.fromfile(file, endian + 'f')
     shape = (height, width, 3) if color else (height, width)
-
-    data = np.reshape(data, shape)
-    data = np.flipud(data)
-    file.close()
+    return shape, endian, scale
+
+
+def read_pfm(filename, materialize=False):
+    """
+    Memory-map a PFM file and return (data, scale). data is a flipped (bottom-up rows), copy-on-write view of
+    the file, pages are only read when they are used; materialize=True returns a contiguous native float32 copy
+    instead, which is what cv2 needs.
+    """
+    with open(filename, 'rb') as file:
+        shape, endian, scale = read_pfm_header(file)
+        offset = file.tell()
+
+    data = np.memmap(filename, dtype=endian + 'f', mode='c', offset=offset, shape=shape).view(np.ndarray)
+    data = data[::-1]
+    if materialize:
+        data = np.ascontiguousarray(data, dtype=np.float32)
     return data, scale
 
 
 def save_pfm(filename, image, scale=1):
-    file = open(filename, "wb")
-    color = None
-
-    image = np.flipud(image)
-
     if image.dtype.name != 'float32':
         raise Exception('Image dtype must be float32.')
 
@@ -57,18 +57,84 @@ def save_pfm(filename, image, scale=1):
     else:
         raise Exception('Image must have H x W x 3, H x W x 1 or H x W dimensions.')
 
-    file.write('PF\n'.encode('utf-8') if color else 'Pf\n'.encode('utf-8'))
-    file.write('{} {}\n'.format(image.shape[1], image.shape[0]).encode('utf-8'))
-
     endian = image.dtype.byteorder
 
     if endian == '<' or endian == '=' and sys.byteorder == 'little':
         scale = -scale
 
-    file.write(('%f\n' % scale).encode('utf-8'))
+    with open(filename, "wb") as file:
+        file.write('PF\n'.encode('utf-8') if color else 'Pf\n'.encode('utf-8'))
+        file.write('{} {}\n'.format(image.shape[1], image.shape[0]).encode('utf-8'))
+        file.write(('%f\n' % scale).encode('utf-8'))
+        # PFM stores the rows bottom-up, stream them in that order instead of writing a flipped copy
+        for row in image[::-1]:
+            file.write(np.ascontiguousarray(row).data)
+
+
+def read_cam_file(filename):
+    with open(filename) as f:
+        lines = f.readlines()
+        lines = [line.rstrip() for line in lines]
+    # extrinsics: line [1,5), 4x4 matrix
+    extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
+    # intrinsics: line [7-10), 3x3 matrix
+    intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+    # depth_min & depth_interval (& num_depth): line 11
+    depth_params = [float(x) for x in lines[11].split()]
+    return intrinsics, extrinsics, depth_params
+
+
+# read a pair file, [(ref_view1, [src_view1-1, ...]), (ref_view2, [src_view2-1, ...]), ...]
+def read_pair_file(filename):
+    data = []
+    with open(filename) as f:
+        num_viewpoint = int(f.readline())
+        for view_idx in range(num_viewpoint):
+            ref_view = int(f.readline().rstrip())
+            src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]
+            data.append((ref_view, src_views))
+    return data
+
+
+def stage_proj_matrices(proj_matrices, num_stage=3):
+    """ (..., 2, 4, 4) -> (num_stage, ..., 2, 4, 4), the intrinsics are doubled at every stage """
+    proj_matrices_ms = np.repeat(proj_matrices[np.newaxis], num_stage, axis=0)
+    for stage_idx in range(1, num_stage):
+        proj_matrices_ms[stage_idx, ..., 1, :2, :] *= 2 ** stage_idx
+    return proj_matrices_ms
+
+
+class CameraTable(object):
+    """Cameras of a set of views parsed once into numpy arrays and looked up by view id.
+
+    proj_matrices: (N, 2, 4, 4), extrinsics in [:, 0] and intrinsics in [:, 1, :3, :3]
+    proj_matrices_ms: (num_stage, N, 2, 4, 4)
+    depth_params: (N, 3) float64, the values of the depth line of the cam file (nan if absent)
+    """
+    def __init__(self, filenames, intrinsics_scale=1.0, num_stage=3):
+        vids = sorted(filenames.keys())
+        self.num_stage = num_stage
+        self.remap = np.full(max(vids) + 1, -1, dtype=np.int64)
+        self.proj_matrices = np.zeros((len(vids), 2, 4, 4), dtype=np.float32)
+        self.depth_params = np.full((len(vids), 3), np.nan, dtype=np.float64)
+        for i, vid in enumerate(vids):
+            intrinsics, extrinsics, depth_params = read_cam_file(filenames[vid])
+            if intrinsics_scale != 1.0:
+                intrinsics[:2, :] *= intrinsics_scale
+            self.remap[vid] = i
+            self.proj_matrices[i, 0, :4, :4] = extrinsics
+            self.proj_matrices[i, 1, :3, :3] = intrinsics
+            self.depth_params[i, :len(depth_params)] = depth_params[:3]
+        self.proj_matrices_ms = stage_proj_matrices(self.proj_matrices, num_stage)
+
+    def index(self, vids):
+        return self.remap[np.asarray(vids, dtype=np.int64)]
+
+    def stage_proj_matrices(self, vids):
+        """ {"stage1": (V, 2, 4, 4), ...} for the given view ids """
+        proj_matrices_ms = self.proj_matrices_ms[:, self.index(vids)]
+        return {"stage{}".format(stage_idx + 1): proj_matrices_ms[stage_idx] for stage_idx in range(self.num_stage)}
 
-    image.tofile(file)
-    file.close()
 
 import random, cv2
 class RandomCrop(object):
@@ -5,6 +5,8 @@ import os, cv2
 from PIL import Image
 from torchvision import transforms
 from datasets.data_io import *
+from datasets.image_store import ImageStore, rectified_filename
+from datasets.gt_cache import GTCache, GTMemoryCache
 
 class MVSDataset(Dataset):
     def __init__(self, args, list_file, mode):
@@ -17,9 +19,21 @@ class MVSDataset(Dataset):
         self.ndepths = args.numdepth
         self.interval_scale = args.interval_scale
         self.random_view = False
+        # pre-decoded images written by datasets/image_store.py, PNG decoding is used when there is none
+        store_dir = args.image_store or os.path.join(self.datapath, "image_store")
+        self.image_store = ImageStore(store_dir) if ImageStore.exists(store_dir) else None
+        # depth/mask pyramids written by datasets/gt_cache.py, shared by the 7 lighting samples of a ref view
+        cache_dir = args.gt_cache or os.path.join(self.datapath, "gt_cache")
+        self.gt_cache = GTCache(cache_dir) if GTCache.exists(cache_dir) else None
 
         assert self.mode in ["train", "val", "test"]
         self.metas = self.build_list()
+        # the locality sampler revisits a ref view one light later, after the other ref views of the scan
+        gt_cache_size = args.gt_cache_size
+        if gt_cache_size < 0:
+            gt_cache_size = max(len(set(meta[2] for meta in self.metas if meta[0] == scan))
+                                for scan in set(meta[0] for meta in self.metas))
+        self.gt_memory = GTMemoryCache(gt_cache_size)
         self.define_transforms()
 
     def build_list(self):
@@ -29,27 +43,26 @@ class MVSDataset(Dataset):
             scans = [line.rstrip() for line in scans]
 
         self.id_list = []
+        # read the pair file once, it is shared by all scans
+        pair_data = read_pair_file(os.path.join(self.datapath, "Cameras/pair.txt"))
         # scans
         for scan in scans:
-            pair_file = "Cameras/pair.txt"
-            # read the pair file
-            with open(os.path.join(self.datapath, pair_file)) as f:
-                num_viewpoint = int(f.readline())
-                # viewpoints (49)
-                for view_idx in range(num_viewpoint):
-                    ref_view = int(f.readline().rstrip())
-                    src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]       
-                    if self.mode == "val":
-                        for light_idx in range(7):
-                            metas.append((scan, light_idx, ref_view, src_views))
-                            self.id_list.append([ref_view] + src_views)
-                    else:
-                        assert self.mode == "train"
-                        for light_idx in range(7):
-                            metas.append((scan, light_idx, ref_view, src_views))
-                            self.id_list.append([ref_view] + src_views)
+            # viewpoints (49)
+            for ref_view, src_views in pair_data:
+                if self.mode == "val":
+                    for light_idx in range(7):
+                        metas.append((scan, light_idx, ref_view, src_views))
+                        self.id_list.append([ref_view] + src_views)
+                else:
+                    assert self.mode == "train"
+                    for light_idx in range(7):
+                        metas.append((scan, light_idx, ref_view, src_views))
+                        self.id_list.append([ref_view] + src_views)
         self.id_list = np.unique(self.id_list)
         self.build_remap()
+        # the cameras are shared by all scans, parse each of them once
+        self.cams = CameraTable({vid: os.path.join(self.datapath, 'Cameras/train/{:0>8}_cam.txt'.format(vid))
+                                 for vid in self.id_list})
         print("dataset", self.mode, "metas:", len(metas))
         return metas
 
@@ -73,34 +86,28 @@ class MVSDataset(Dataset):
     def __len__(self):
         return len(self.metas)
 
-    def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
-        # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0]) 
-        depth_interval = float(lines[11].split()[1]) * self.interval_scale 
-        depth_max = depth_min + depth_interval * self.ndepths
-        return intrinsics, extrinsics, depth_min, depth_interval, [depth_min, depth_max]
+    def depth_range(self, vid):
+        depth_min, depth_interval = self.cams.depth_params[self.cams.index(vid), :2]
+        return float(depth_min), float(depth_interval) * self.interval_scale
 
     def read_img(self, filename):
         img = Image.open(filename)
         np_img = np.array(img, dtype=np.float32) / 255.0
         return np_img
 
-    def read_img_seg(self, filename):
-        img = Image.open(filename)
-        return self.transform_seg(img)
-
+    def read_view_img(self, scan, light_idx, vid):
+        if self.image_store is not None and scan in self.image_store:
+            return self.image_store.read(scan, light_idx, vid)
+        img_filename = rectified_filename(self.datapath, scan, light_idx, vid)
+        return cv2.cvtColor(cv2.imread(img_filename), cv2.COLOR_BGR2RGB)
 
-    def read_img_aug(self, filename):
-        img = Image.open(filename)
-        img = self.transform_aug(img)
-        return img
+    def read_view_imgs(self, scan, light_idx, vids):
+        """ decode every unique view of a sample once, (h, w, 3) uint8 RGB """
+        view_imgs = {}
+        for vid in vids:
+            if vid not in view_imgs:
+                view_imgs[vid] = self.read_view_img(scan, light_idx, vid)
+        return view_imgs
 
     def center_image(self, img):
         """ normalize image input """
@@ -151,7 +158,7 @@ class MVSDataset(Dataset):
         return np_img_ms   
     
     def read_depth_all(self, filename):
-        depth_h = np.array(read_pfm(filename)[0], dtype=np.float32)  # (800, 800)
+        depth_h = read_pfm(filename, materialize=True)[0]  # (800, 800)
         depth_h = cv2.resize(depth_h, None, fx=0.5, fy=0.5,
                                 interpolation=cv2.INTER_NEAREST)  # (600, 800)
         depth_h = depth_h[44:556, 80:720]  # (512, 640)
@@ -162,11 +169,11 @@ class MVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return read_pfm(filename, materialize=True)[0]
 
 
     def read_depth_hr(self, filename):
-        depth_hr = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth_hr = read_pfm(filename, materialize=True)[0]
         depth_lr = self.prepare_img(depth_hr)
         h, w = depth_lr.shape
         depth_lr_ms = {
@@ -177,7 +184,7 @@ class MVSDataset(Dataset):
         return depth_lr_ms
     
     def read_depth_hr_crop(self, filename):
-        depth_hr = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth_hr = read_pfm(filename, materialize=True)[0]
         depth_lr = depth_hr[:1184,:]
         h, w = depth_lr.shape
         depth_lr_ms = {
@@ -187,6 +194,19 @@ class MVSDataset(Dataset):
         }
         return depth_lr_ms
 
+    def read_gt_hr(self, scan, vid):
+        mask_filename_hr = os.path.join(self.datapath, 'Depths_raw/{}/depth_visual_{:0>4}.png'.format(scan, vid))
+        depth_filename_hr = os.path.join(self.datapath, 'Depths_raw/{}/depth_map_{:0>4}.pfm'.format(scan, vid))
+        return self.read_depth_hr(depth_filename_hr), self.read_mask_hr(mask_filename_hr)
+
+    def read_gt(self, scan, vid):
+        return self.gt_memory.read((scan, vid), self.read_gt_file)
+
+    def read_gt_file(self, scan, vid):
+        if self.gt_cache is not None and (scan, vid) in self.gt_cache:
+            return self.gt_cache.read(scan, vid)
+        return self.read_gt_hr(scan, vid)
+
     def __getitem__(self, idx):
         sample = {}
         meta = self.metas[idx]
@@ -206,56 +226,27 @@ class MVSDataset(Dataset):
         imgs = []
         imgs_aug = []
         center_imgs = []
-        mask = None
-        depth_values = None
-        init_depth_hypotheses = None
-        proj_matrices = []
+        view_imgs = self.read_view_imgs(scan, light_idx, view_ids + view_ids_scc)
 
         for i, vid in enumerate(view_ids):
-            # NOTE that the id in image file names is from 1 to 49 (not 0~48)
-            img_filename = os.path.join(self.datapath,
-                                        'Rectified/{}_train/rect_{:0>3}_{}_r5000.png'.format(scan, vid + 1, light_idx))
-            mask_filename_hr = os.path.join(self.datapath, 'Depths_raw/{}/depth_visual_{:0>4}.png'.format(scan, vid))
-            depth_filename_hr = os.path.join(self.datapath, 'Depths_raw/{}/depth_map_{:0>4}.pfm'.format(scan, vid))
-            proj_mat_filename = os.path.join(self.datapath, 'Cameras/train/{:0>8}_cam.txt').format(vid)
-            # img = self.read_img(img_filename)
-            image_aug = self.read_img_aug(img_filename)
-            image_seg = self.read_img_seg(img_filename)
-            center_img = self.center_image(cv2.cvtColor(cv2.imread(img_filename), cv2.COLOR_BGR2RGB))           
-            intrinsics, extrinsics, depth_min, depth_interval, _ = self.read_cam_file(proj_mat_filename)
-            proj_mat = np.zeros(shape=(2, 4, 4), dtype=np.float32)
-            proj_mat[0, :4, :4] = extrinsics
-            proj_mat[1, :3, :3] = intrinsics
-            proj_matrices.append(proj_mat)
-            if i == 0:  # reference view
-                mask_read_ms = self.read_mask_hr(mask_filename_hr)
-                depth_ms = self.read_depth_hr(depth_filename_hr)
-                # get depth values
-                depth_max = depth_interval * self.ndepths + depth_min
-                depth_values = np.arange(depth_min, depth_max, depth_interval, dtype=np.float32)
-                init_depth_hypotheses = np.arange(depth_min, depth_max, depth_interval, dtype=np.float32)
-                mask = mask_read_ms
-            imgs.append(image_seg)
-            imgs_aug.append(image_aug)
-            center_imgs.append(center_img)
+            imgs.append(self.transform_seg(view_imgs[vid]))
+            imgs_aug.append(self.transform_aug(Image.fromarray(view_imgs[vid])))
+            center_imgs.append(self.center_image(view_imgs[vid]))
         imgs = np.stack(imgs)
         center_imgs = np.stack(center_imgs).transpose([0, 3, 1, 2])
         imgs_aug = torch.stack(imgs_aug)
 
-        # ms proj_mats
-        proj_matrices = np.stack(proj_matrices)
-        stage2_pjmats = proj_matrices.copy()
-        stage2_pjmats[:, 1, :2, :] = proj_matrices[:, 1, :2, :] * 2
-        stage3_pjmats = proj_matrices.copy()
-        stage3_pjmats[:, 1, :2, :] = proj_matrices[:, 1, :2, :] * 4
-        proj_matrices_ms = {
-            "stage1": proj_matrices,
-            "stage2": stage2_pjmats,
-            "stage3": stage3_pjmats
-        }
+        # reference view
+        depth_ms, mask = self.read_gt(scan, ref_view)
+        # get depth values
+        depth_min, depth_interval = self.depth_range(ref_view)
+        depth_max = depth_interval * self.ndepths + depth_min
+        depth_values = np.arange(depth_min, depth_max, depth_interval, dtype=np.float32)
+        init_depth_hypotheses = np.arange(depth_min, depth_max, depth_interval, dtype=np.float32)
+
         sample["imgs"] = imgs
         sample["imgs_aug"] = imgs_aug
-        sample["proj_matrices"] = proj_matrices_ms
+        sample["proj_matrices"] = self.cams.stage_proj_matrices(view_ids)
         sample["depth"] = depth_ms
         sample["depth_values"] = depth_values
         sample["mask"] = mask
@@ -263,34 +254,9 @@ class MVSDataset(Dataset):
         sample["view_ids"] = view_ids
         sample["view_ids_scc"] = view_ids_scc
         sample['init_depth_hypotheses'] = init_depth_hypotheses.astype(np.float32)
-        imgs_scc = []
-        proj_matrices_scc = []
-
-        for i, vid in enumerate(view_ids_scc):
-            # NOTE that the id in image file names is from 1 to 49 (not 0~48)
-            img_filename = os.path.join(self.datapath,
-                                        'Rectified/{}_train/rect_{:0>3}_{}_r5000.png'.format(scan, vid + 1, light_idx))
-            proj_mat_filename = os.path.join(self.datapath, 'Cameras/train/{:0>8}_cam.txt').format(vid)
-            image_scc = self.read_img_seg(img_filename)
-            intrinsics, extrinsics, depth_min, depth_interval, _ = self.read_cam_file(proj_mat_filename)
-            proj_mat_scc = np.zeros(shape=(2, 4, 4), dtype=np.float32)
-            proj_mat_scc[0, :4, :4] = extrinsics
-            proj_mat_scc[1, :3, :3] = intrinsics
-            proj_matrices_scc.append(proj_mat_scc)
-            imgs_scc.append(image_scc)
-        imgs_scc = np.stack(imgs_scc)
-        proj_matrices_scc = np.stack(proj_matrices_scc)
-        stage2_pjmats_scc = proj_matrices_scc.copy()
-        stage2_pjmats_scc[:, 1, :2, :] = proj_matrices_scc[:, 1, :2, :] * 2
-        stage3_pjmats_scc = proj_matrices_scc.copy()
-        stage3_pjmats_scc[:, 1, :2, :] = proj_matrices_scc[:, 1, :2, :] * 4
-        proj_matrices_ms_scc = {
-            "stage1": proj_matrices_scc,
-            "stage2": stage2_pjmats_scc,
-            "stage3": stage3_pjmats_scc
-        }
-        sample["imgs_scc"] = imgs_scc
-        sample["proj_matrices_scc"] = proj_matrices_ms_scc
+
+        sample["imgs_scc"] = np.stack([self.transform_seg(view_imgs[vid]) for vid in view_ids_scc])
+        sample["proj_matrices_scc"] = self.cams.stage_proj_matrices(view_ids_scc)
 
         return sample
 
@@ -34,6 +34,7 @@ class MVSDataset(Dataset):
         scans = self.list_file
 
         interval_scale_dict = {}
+        self.cams = {}
         # scans
         for scan in scans:
             # determine the interval scale of each scene. default is 1.06
@@ -42,20 +43,21 @@ class MVSDataset(Dataset):
             else:
                 interval_scale_dict[scan] = self.interval_scale[scan]
 
-            pair_file = "{}/pair.txt".format(scan)
             # read the pair file
-            with open(os.path.join(self.data_path, pair_file)) as f:
-                num_viewpoint = int(f.readline())
-                # viewpoints
-                for view_idx in range(num_viewpoint):
-                    ref_view = int(f.readline().rstrip())
-                    src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]
-                    # filter by no src view and fill to nviews
-                    if len(src_views) > 0:
-                        if len(src_views) < self.nviews - 1:
-                            print("{}< src num_views:{}".format(len(src_views), self.nviews))
-                            src_views += [src_views[0]] * (self.nviews - len(src_views))
-                        metas.append((scan, ref_view, src_views, scan))
+            pair_data = read_pair_file(os.path.join(self.data_path, "{}/pair.txt".format(scan)))
+            # viewpoints
+            for ref_view, src_views in pair_data:
+                # filter by no src view and fill to nviews
+                if len(src_views) > 0:
+                    if len(src_views) < self.nviews - 1:
+                        print("{}< src num_views:{}".format(len(src_views), self.nviews))
+                        src_views += [src_views[0]] * (self.nviews - len(src_views))
+                    metas.append((scan, ref_view, src_views, scan))
+
+            # parse every camera of the scene once
+            vids = set(v for ref_view, src_views in pair_data for v in [ref_view] + src_views)
+            self.cams[scan] = CameraTable({vid: os.path.join(self.data_path, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
+                                           for vid in vids}, intrinsics_scale=0.25)
 
         self.interval_scale = interval_scale_dict
         print("dataset", self.mode, "metas:", len(metas), "interval_scale:{}".format(self.interval_scale))
@@ -70,27 +72,18 @@ class MVSDataset(Dataset):
     def __len__(self):
         return len(self.metas)
 
-    def read_cam_file(self, filename, interval_scale):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
-        intrinsics[:2, :] /= 4.0
-        # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
-        depth_interval = float(lines[11].split()[1])
-
-        if len(lines[11].split()) >= 3:
-            num_depth = lines[11].split()[2]
-            depth_max = depth_min + int(float(num_depth)) * depth_interval
+    def depth_range(self, scan, vid, interval_scale):
+        cams = self.cams[scan]
+        depth_min, depth_interval, num_depth = cams.depth_params[cams.index(vid)]
+        depth_min, depth_interval = float(depth_min), float(depth_interval)
+
+        if not np.isnan(num_depth):
+            depth_max = depth_min + int(num_depth) * depth_interval
             depth_interval = (depth_max - depth_min) / self.ndepths
 
         depth_interval *= interval_scale
 
-        return intrinsics, extrinsics, depth_min, depth_interval
+        return depth_min, depth_interval
 
     def read_img(self, filename):
         img = Image.open(filename)
@@ -101,7 +94,7 @@ class MVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return read_pfm(filename, materialize=True)[0]
 
     def scale_mvs_input(self, img, intrinsics, max_w, max_h, base=32):
         h, w = img.shape[:2]
@@ -126,18 +119,17 @@ class MVSDataset(Dataset):
         imgs_raw = []
         depth_values = None
         init_depth_hypotheses = None
-        proj_matrices = []
+        cams = self.cams[scan]
+        proj_matrices = cams.proj_matrices[cams.index(view_ids)]
+        rescaled = False
 
         for i, vid in enumerate(view_ids):
             img_filename = os.path.join(self.data_path, '{}/images_post/{:0>8}.jpg'.format(scan, vid))
             if not os.path.exists(img_filename):
                 img_filename = os.path.join(self.data_path, '{}/images/{:0>8}.jpg'.format(scan, vid))
-                
-            proj_mat_filename = os.path.join(self.data_path, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
-            
+
             img = self.read_img(img_filename)
-            intrinsics, extrinsics, depth_min, depth_interval = self.read_cam_file(proj_mat_filename, interval_scale=
-            self.interval_scale[scene_name])
+            intrinsics = proj_matrices[i, 1, :3, :3]
             # scale input
             if self.crop:
                 img = img[:1184,:,:]
@@ -145,6 +137,7 @@ class MVSDataset(Dataset):
                 pass      
             else:
                 img, intrinsics = self.scale_mvs_input(img, intrinsics, self.max_w, self.max_h)
+                rescaled = True
 
             img = self.transform_seg(img)
 
@@ -167,15 +160,12 @@ class MVSDataset(Dataset):
                 img = cv2.resize(img, (s_w, s_h))
                 intrinsics[0, :] *= scale_w
                 intrinsics[1, :] *= scale_h
+                rescaled = True
 
             imgs.append(img)
-            # extrinsics, intrinsics
-            proj_mat = np.zeros(shape=(2, 4, 4), dtype=np.float32)  #
-            proj_mat[0, :4, :4] = extrinsics
-            proj_mat[1, :3, :3] = intrinsics
-            proj_matrices.append(proj_mat)
 
             if i == 0:  # reference view
+                depth_min, depth_interval = self.depth_range(scan, vid, self.interval_scale[scene_name])
                 if self.inverse_depth:
                     depth_end = depth_interval * self.ndepths + depth_min
                     init_depth_hypotheses = np.linspace(1.0 / depth_min, 1.0 / depth_end, self.ndepths, endpoint=False)
@@ -186,21 +176,18 @@ class MVSDataset(Dataset):
                     depth_values = np.arange(depth_min, depth_interval * (self.ndepths - 0.5) + depth_min, depth_interval,
                                          dtype=np.float32)
         imgs = np.stack(imgs)
-        proj_matrices = np.stack(proj_matrices)
-
-        stage2_pjmats = proj_matrices.copy()
-        stage2_pjmats[:, 1, :2, :] = proj_matrices[:, 1, :2, :] * 2
-        stage3_pjmats = proj_matrices.copy()
-        stage3_pjmats[:, 1, :2, :] = proj_matrices[:, 1, :2, :] * 4
-
-        proj_matrices_ms = {
-            "stage1": proj_matrices,
-            "stage2": stage2_pjmats,
-            "stage3": stage3_pjmats
-        }
+
+        if rescaled:
+            # the intrinsics were changed along with the images, so the stage matrices can't come from the table
+            proj_matrices_ms = {"stage{}".format(stage_idx + 1): stage_pjmats
+                                for stage_idx, stage_pjmats in enumerate(stage_proj_matrices(proj_matrices))}
+        else:
+            proj_matrices_ms = cams.stage_proj_matrices(view_ids)
         return {"imgs": imgs,
                 "proj_matrices": proj_matrices_ms,
                 "init_depth_hypotheses": init_depth_hypotheses,
                 "depth_values": depth_values,
+                "scene": scene_name,
+                "view_ids": view_ids,
                 "filename": scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}"}
 
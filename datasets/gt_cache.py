@@ -0,0 +1,93 @@
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+
+INDEX_FILE = "index.json"
+
+
+def gt_cache_filename(cache_dir, scan, vid):
+    return os.path.join(cache_dir, scan, "{:0>4}.npy".format(vid))
+
+
+def build_gt_cache(dataset, out_dir):
+    """ write the stage1/2/3 depth and mask pyramids of every (scan, ref_view) of a dtu_cl dataset """
+    index_filename = os.path.join(out_dir, INDEX_FILE)
+    index = {"stages": None, "entries": {}}
+    if os.path.exists(index_filename):
+        with open(index_filename) as f:
+            index = json.load(f)
+
+    for scan in sorted(set(meta[0] for meta in dataset.metas)):
+        ref_views = sorted(set(meta[2] for meta in dataset.metas if meta[0] == scan))
+        os.makedirs(os.path.join(out_dir, scan), exist_ok=True)
+        for vid in ref_views:
+            depth_ms, mask_ms = dataset.read_gt_hr(scan, vid)
+            stages = {k: list(v.shape) for k, v in sorted(depth_ms.items())}
+            if index["stages"] is None:
+                index["stages"] = stages
+            assert index["stages"] == stages, "pyramid shapes differ from the cached ones"
+            # row 0 holds the depth pyramid, row 1 the mask pyramid, stage after stage
+            pyramid = np.stack([np.concatenate([depth_ms[k].ravel() for k in sorted(stages)]),
+                                np.concatenate([mask_ms[k].ravel() for k in sorted(stages)])]).astype(np.float32)
+            np.save(gt_cache_filename(out_dir, scan, vid), pyramid)
+        index["entries"][scan] = sorted(set(index["entries"].get(scan, []) + ref_views))
+        with open(index_filename, "w") as f:
+            json.dump(index, f)
+        print("gt cache", scan, "ref views:", len(ref_views))
+    return index
+
+
+class GTCache(object):
+    """Reader for the pyramids written by build_gt_cache.
+
+    Every (scan, ref_view) file is memory-mapped (copy-on-write) and the stages are returned as views of it.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.stages = index["stages"]
+        self.entries = set((scan, vid) for scan, vids in index["entries"].items() for vid in vids)
+
+    @staticmethod
+    def exists(cache_dir):
+        return cache_dir is not None and os.path.exists(os.path.join(cache_dir, INDEX_FILE))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def read(self, scan, vid):
+        pyramid = np.load(gt_cache_filename(self.cache_dir, scan, vid), mmap_mode="c")
+        depth_ms, mask_ms = {}, {}
+        offset = 0
+        for k in sorted(self.stages):
+            h, w = self.stages[k]
+            depth_ms[k] = pyramid[0, offset: offset + h * w].reshape(h, w)
+            mask_ms[k] = pyramid[1, offset: offset + h * w].reshape(h, w)
+            offset += h * w
+        return depth_ms, mask_ms
+
+
+class GTMemoryCache(object):
+    """LRU of the depth/mask pyramids read by a dataset, keyed by (scan, vid).
+
+    Every ref view is read once per light otherwise. The cache is a plain OrderedDict so the dataset stays
+    picklable for the DataLoader workers, each worker fills its own copy.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def read(self, key, read_func):
+        if self.max_size <= 0:
+            return read_func(*key)
+        gt = self.entries.get(key)
+        if gt is not None:
+            self.entries.move_to_end(key)
+            return gt
+        gt = read_func(*key)
+        self.entries[key] = gt
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return gt
@@ -0,0 +1,73 @@
+import os
+import json
+import numpy as np
+import cv2
+
+INDEX_FILE = "index.json"
+
+
+def rectified_filename(datapath, scan, light_idx, vid):
+    # NOTE that the id in image file names is from 1 to 49 (not 0~48)
+    return os.path.join(datapath, 'Rectified/{}_train/rect_{:0>3}_{}_r5000.png'.format(scan, vid + 1, light_idx))
+
+
+def build_image_store(datapath, scans, out_dir, num_lights=7):
+    """ decode Rectified/{scan}_train/rect_*_r5000.png into one (light, view, h, w, 3) uint8 .npy per scan """
+    os.makedirs(out_dir, exist_ok=True)
+    index_filename = os.path.join(out_dir, INDEX_FILE)
+    index = {}
+    if os.path.exists(index_filename):
+        with open(index_filename) as f:
+            index = json.load(f)
+
+    for scan in scans:
+        img_dir = os.path.join(datapath, 'Rectified/{}_train'.format(scan))
+        vids = sorted(int(name.split("_")[1]) - 1 for name in os.listdir(img_dir) if name.endswith("_0_r5000.png"))
+        h, w = cv2.imread(rectified_filename(datapath, scan, 0, vids[0])).shape[:2]
+
+        filename = "{}.npy".format(scan)
+        store = np.lib.format.open_memmap(os.path.join(out_dir, filename), mode="w+", dtype=np.uint8,
+                                          shape=(num_lights, len(vids), h, w, 3))
+        for light_idx in range(num_lights):
+            for i, vid in enumerate(vids):
+                img = cv2.imread(rectified_filename(datapath, scan, light_idx, vid))
+                store[light_idx, i] = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        store.flush()
+        del store
+
+        index[scan] = {"file": filename, "views": vids}
+        # rewrite the index after every scan so that an interrupted build stays usable
+        with open(index_filename, "w") as f:
+            json.dump(index, f)
+        print("image store", scan, "views:", len(vids), "lights:", num_lights, "size:", (h, w))
+    return index
+
+
+class ImageStore(object):
+    """Reader for the arrays written by build_image_store.
+
+    The per-scan arrays are memory-mapped lazily (copy-on-write), so every DataLoader worker slices the
+    same page cache and nothing is decoded or copied until the pixels are used.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.arrays = {}
+        self.view_pos = {}
+
+    @staticmethod
+    def exists(store_dir):
+        return store_dir is not None and os.path.exists(os.path.join(store_dir, INDEX_FILE))
+
+    def __contains__(self, scan):
+        return scan in self.index
+
+    def read(self, scan, light_idx, vid):
+        """ (h, w, 3) uint8 RGB view into the store """
+        if scan not in self.arrays:
+            entry = self.index[scan]
+            self.arrays[scan] = np.load(os.path.join(self.store_dir, entry["file"]), mmap_mode="c")
+            self.view_pos[scan] = {v: i for i, v in enumerate(entry["views"])}
+        return self.arrays[scan][light_idx, self.view_pos[scan][vid]]
+
@@ -0,0 +1,54 @@
+import math
+import torch
+from torch.utils.data import Sampler
+
+
+class LocalitySampler(Sampler):
+    """Cache friendly training order for datasets with (scan, light_idx, ref_view, ...) metas.
+
+    Scans are shuffled, then the samples of a scan are sorted by (light_idx, ref_view) and cut into blocks of
+    `window` samples; the blocks and the samples inside each block are shuffled. Consecutive samples therefore
+    read neighbouring views of the same scan and light. The order is seeded by the epoch and is the same on
+    every rank, each rank takes a contiguous, disjoint part of it.
+    """
+    def __init__(self, dataset, window=16, num_replicas=1, rank=0, seed=0):
+        assert window > 0 and 0 <= rank < num_replicas
+        self.window = window
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        self.groups = {}
+        for idx, meta in enumerate(dataset.metas):
+            self.groups.setdefault(meta[0], []).append(idx)
+        for scan, indices in self.groups.items():
+            indices.sort(key=lambda i: (dataset.metas[i][1], dataset.metas[i][2]))
+        self.scans = sorted(self.groups)
+
+        self.num_samples = int(math.ceil(len(dataset.metas) / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        order = []
+        for scan_idx in torch.randperm(len(self.scans), generator=g).tolist():
+            indices = self.groups[self.scans[scan_idx]]
+            blocks = [indices[i: i + self.window] for i in range(0, len(indices), self.window)]
+            for block_idx in torch.randperm(len(blocks), generator=g).tolist():
+                block = blocks[block_idx]
+                order += [block[i] for i in torch.randperm(len(block), generator=g).tolist()]
+
+        # pad to make it evenly divisible
+        while len(order) < self.total_size:
+            order += order[:self.total_size - len(order)]
+
+        return iter(order[self.rank * self.num_samples: (self.rank + 1) * self.num_samples])
+
+    def __len__(self):
+        return self.num_samples
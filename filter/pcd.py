@@ -72,7 +72,9 @@ def reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, i
     # find the depth estimation of the source view
     x_src = xy_src[0].reshape([height, width]).astype(np.float32)
     y_src = xy_src[1].reshape([height, width]).astype(np.float32)
-    sampled_depth_src = cv2.remap(depth_src, x_src, y_src, interpolation=cv2.INTER_LINEAR)
+    # cv2 needs a contiguous copy of the memory-mapped depth
+    sampled_depth_src = cv2.remap(np.ascontiguousarray(depth_src, dtype=np.float32), x_src, y_src,
+                                  interpolation=cv2.INTER_LINEAR)
 
     # source 3D space
     # NOTE that we should use sampled source-view depth_here to project back
@@ -120,6 +122,11 @@ def filter_depth(args, pair_folder, scan_folder, out_folder, plyfilename):
     pair_data = read_pair_file(pair_file)
     nviews = len(pair_data)
 
+    # every estimated depth map is used once as reference and about 10 times as source, the memory-mapped views
+    # share the page cache instead of keeping a private copy of every depth map of the scene
+    def read_depth_est(view):
+        return read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(view)))[0]
+
     # for each reference view and the corresponding source views
     for ref_view, src_views in pair_data:
         # load the camera parameters
@@ -128,7 +135,7 @@ def filter_depth(args, pair_folder, scan_folder, out_folder, plyfilename):
         # load the reference image
         ref_img = read_img(os.path.join(scan_folder, 'images/{:0>8}.png'.format(ref_view)))
         # load the estimated depth of the reference view
-        ref_depth_est = read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(ref_view)))[0]
+        ref_depth_est = read_depth_est(ref_view)
         # load the photometric mask of the reference view
         confidence = read_pfm(os.path.join(out_folder, 'confidence/{:0>8}.pfm'.format(ref_view)))[0]
         confidence2 = read_pfm(os.path.join(out_folder, 'confidence/{:0>8}_stage2.pfm'.format(ref_view)))[0]
@@ -148,7 +155,7 @@ def filter_depth(args, pair_folder, scan_folder, out_folder, plyfilename):
             src_intrinsics, src_extrinsics = read_camera_parameters(
                 os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)))
             # the estimated depth of the source view
-            src_depth_est = read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(src_view)))[0]
+            src_depth_est = read_depth_est(src_view)
 
             geo_mask, depth_reprojected, x2d_src, y2d_src = check_geometric_consistency(ref_depth_est, ref_intrinsics, ref_extrinsics,
                                                                       src_depth_est,
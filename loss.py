@@ -8,12 +8,43 @@ class MVSLoss(nn.Module):
         super(MVSLoss, self).__init__()
         self.loss_funcs = [UnsupLossMultiStage_l05(args), ICCLossMultiStage(args), SCCLossMultiStage(args)]    
         self.args = args
+        if args.compile_loss:
+            compile_smooth_l0_5()
+
+    def build_pyramid(self, data, outputs):
+        """
+        inputs of the losses at the resolution of every stage, stage1 is 1/4 of the image and every stage doubles it
+        :return: {"stage1": {"imgs": (b, v, c, h, w), "pseudo_depth": (b, h, w), "confidence": (b, h, w),
+                             "filter_mask": (b, h, w) when the icc pass ran}, ...}
+        """
+        imgs = data["center_imgs"]
+        output1 = outputs["output1"]
+        # pseudo labels and masks are downsampled together
+        maps = [output1["depth"].detach(), output1["photometric_confidence"].detach()]
+        if "output2" in outputs:
+            maps.append(outputs["output2"]["filter_mask"][:, 0])
+        maps = torch.stack(maps, 1)
+
+        pyramid = {}
+        for stage_key in [k for k in output1.keys() if "stage" in k]:
+            stage_idx = int(stage_key.replace("stage", "")) - 1
+            scale = 0.25 * 2 ** stage_idx
+            stage_imgs, stage_maps = imgs.flatten(0, 1), maps
+            if scale != 1:
+                stage_imgs = F.interpolate(stage_imgs, scale_factor=scale)
+                stage_maps = F.interpolate(maps, scale_factor=scale)
+            pyramid[stage_key] = {"imgs": stage_imgs.view(*imgs.shape[:2], *stage_imgs.shape[1:]),
+                                  "pseudo_depth": stage_maps[:, 0], "confidence": stage_maps[:, 1]}
+            if "output2" in outputs:
+                pyramid[stage_key]["filter_mask"] = stage_maps[:, 2]
+        return pyramid
 
     def forward(self, data, outputs, epoch_idx):
         losses = {}
         total_loss = torch.tensor(0.0, dtype=torch.float32, device=data["imgs"].device, requires_grad=False)
+        pyramid = self.build_pyramid(data, outputs)
         for loss_func in self.loss_funcs:
-            loss, _ = loss_func(data, outputs, epoch_idx)
+            loss, _ = loss_func(data, outputs, epoch_idx, pyramid=pyramid)
             losses[loss_func.name] = loss.item()
             total_loss = total_loss + loss
         return total_loss, losses
@@ -21,27 +52,39 @@ class MVSLoss(nn.Module):
 from torchvision.models import vgg19
 
 class PerceptualLoss_01(nn.Module):
-    def __init__(self, device, layers=['relu_1_1', 'relu_2_1', 'relu_3_1', 'relu_4_1']):
+    """MSE between VGG19 features of warped views and of their reference image, summed over self.layers.
+
+    The reference goes through VGG once for all the views, the views go through it as one batch and VGG stops at
+    the deepest requested layer. layers are names of the modules of vgg19().features, requested names that are
+    not among them select nothing.
+    """
+    def __init__(self, layers=['relu_1_1', 'relu_2_1', 'relu_3_1', 'relu_4_1']):
         super(PerceptualLoss_01, self).__init__()
-        self.vgg = vgg19(pretrained=True).features[:16].to(device).eval()
+        self.vgg = vgg19(pretrained=True).features[:16].eval()
         for param in self.vgg.parameters():
             param.requires_grad = False
         self.layers = layers
-        self.device = device
+        names = list(self.vgg._modules.keys())
+        self.num_layers = max([names.index(name) + 1 for name in layers if name in names], default=0)
 
     def forward(self, input, target):
-        # 确保input和target都在self.device上
-        input = input.to(self.device)
-        target = target.to(self.device).detach()  # No gradients for target
-        
-        loss = 0.0
-        x = input
-        y = target
-        for name, layer in self.vgg._modules.items():
+        """
+        :param input: (b, v, c, h, w) warped views
+        :param target: (b, c, h, w) reference image
+        :return: (v,) loss of every view
+        """
+        b, v = input.shape[:2]
+        loss = torch.zeros(v, dtype=torch.float32, device=input.device)
+        if self.num_layers == 0:
+            return loss
+        x = input.flatten(0, 1)
+        y = target.detach()  # No gradients for target
+        for name, layer in list(self.vgg._modules.items())[:self.num_layers]:
             x = layer(x)
             y = layer(y)
             if name in self.layers:
-                loss += F.mse_loss(x, y)
+                error = x.view(b, v, *x.shape[1:]) - y.unsqueeze(1)
+                loss = loss + torch.mean(error ** 2, dim=(0, 2, 3, 4))
         return loss
 
 class PerceptualLoss(nn.Module):
@@ -74,80 +117,40 @@ class UnSupLoss_01(nn.Module):
         super(UnSupLoss_01, self).__init__()
         self.ssim = SSIM()
         self.args = args
-        self.perceptual_loss_01 = PerceptualLoss_01(device=torch.device('cuda:0' if torch.cuda.is_available() else 'cpu'))
-    def forward(self, imgs, cams, depth, stage_idx):
-        imgs = torch.unbind(imgs, 1)
-        cams = torch.unbind(cams, 1)
-        assert len(imgs) == len(cams), "Different number of images and projection matrices"
-        num_views = len(imgs)
-        ref_img = imgs[0]
-        if stage_idx == 0:
-            ref_img = F.interpolate(ref_img, scale_factor=0.25)
-        elif stage_idx == 1:
-            ref_img = F.interpolate(ref_img, scale_factor=0.5)
-        else:
-            pass
-        ref_img = ref_img.permute(0, 2, 3, 1)  # [B, C, H, W] --> [B, H, W, C]
-        ref_cam = cams[0]
-        self.reconstr_loss = 0
-        self.ssim_loss = 0
-        self.smooth_loss = 0
-        self.perceptual_loss = 0
-        warped_img_list = []
-        mask_list = []
-        reprojection_losses = []
+        self.perceptual_loss_01 = PerceptualLoss_01()
+    def forward(self, imgs, src_projs, depth):
+        """
+        :param imgs: (b, nview, c, h, w) [ref_img, src_img1, ...] at the resolution of the stage
+        :param src_projs: (b, nview-1, 4, 4) K_ref @ E_src @ inverse(K_ref @ E_ref) of the stage
+        :param depth: (b, h, w) reference depth of the stage
+        """
+        ref_img = imgs[:, :1]  # (b, 1, c, h, w)
 
-        perceptual_losses= []
-        for view in range(1, num_views):
-            view_img = imgs[view]
-            view_cam = cams[view]
-            if stage_idx == 0:
-                view_img = F.interpolate(view_img, scale_factor=0.25)
-            elif stage_idx == 1:
-                view_img = F.interpolate(view_img, scale_factor=0.5)
-            else:
-                pass
-            view_img = view_img.permute(0, 2, 3, 1)  # [B, C, H, W] --> [B, H, W, C]
-            warped_img, mask = inverse_warping(view_img, ref_cam, view_cam, depth)  
-            if mask.sum() == 0:
-                self.unsup_loss = torch.tensor(0.0, dtype=torch.float32, device=mask.device)
-                return self.unsup_loss
-            warped_img_list.append(warped_img)
-            mask_list.append(mask)
+        # all source views warped at once, (b, v, c, h, w) and (b, v, 1, h, w)
+        warped_imgs, masks = inverse_warping_views(imgs[:, 1:], src_projs, depth)
+        # the loss of the stage is 0 as soon as one of the views has no valid pixel
+        valid = (masks.sum(dim=(0, 2, 3, 4)) > 0).all().float()
 
-            reconstr_loss = compute_reconstr_loss_l0_5(warped_img, ref_img, mask, simple=False) 
+        reconstr_losses = compute_reconstr_loss_l0_5_views(warped_imgs, ref_img, masks)  # (v,)
+        # replace all 0 values with INF
+        reprojection_volume = reconstr_losses.view(1, -1, 1, 1, 1) + 1e4 * (1 - masks)  # (b, v, 1, h, w)
 
-            valid_mask = 1 - mask  # replace all 0 values with INF
-            reprojection_losses.append(reconstr_loss + 1e4 * valid_mask)
-            # SSIM loss##
-            if view < 3:
-                self.ssim_loss += torch.mean(self.ssim(ref_img, warped_img, mask)) 
-            # print(warped_img.shape) # torch.Size([1, 128, 160, 3])
-            # print(ref_img.shape) # torch.Size([1, 128, 160, 3])
-            warped_img_my = warped_img.permute(0, 3, 1, 2) # [B, H, W, C]->[B, C, H, W] torch.Size([1, 3, 128, 160])
-            # warped_img_my = warped_img_my.squeeze(0) # ([3, 128, 160])
-            
-            ref_img_my = ref_img.permute(0, 3, 1, 2)
-            # ref_img_my = ref_img_my.squeeze(0)
-            # add Perceptual_Loss
-            perceptual_loss_view = self.perceptual_loss_01(warped_img_my, ref_img_my)
-            # print(f"当前perceptual_loss_view的类型为: {type(perceptual_loss_view).__name__}") # float
-            perceptual_losses.append(perceptual_loss_view) # list
-            # print(f"当前perceptual_losses的类型为: {type(perceptual_losses).__name__}")
-            # print("perceptual_losses计算成功---------------------------------------")
-        # perceptual_loss = torch.mean(torch.stack(perceptual_losses))
-        perceptual_loss = torch.tensor(perceptual_losses, dtype=torch.float).mean()
-        self.perceptual_loss += perceptual_loss
+        # SSIM loss of the first two source views##
+        ssim_loss = torch.sum(torch.mean(self.ssim(ref_img, warped_imgs[:, :2], masks[:, :2]), dim=(0, 2, 3, 4)))
+        # add Perceptual_Loss, the reference goes through VGG once for all the views
+        perceptual_loss = torch.mean(self.perceptual_loss_01(warped_imgs, ref_img[:, 0]))
 
         ##smooth loss##
-        self.smooth_loss += depth_smoothness(depth.unsqueeze(dim=-1), ref_img, 1.0)   
-        reprojection_volume = torch.stack(reprojection_losses).permute(1, 2, 3, 4, 0)
-        top_vals, top_inds = torch.topk(torch.neg(reprojection_volume), k=1, sorted=False)
-        top_vals = torch.neg(top_vals)
-        top_mask = top_vals < (1e4 * torch.ones_like(top_vals).cuda())
-        top_mask = top_mask.float()
+        ref_img_nhwc = ref_img.squeeze(1).permute(0, 2, 3, 1)  # [B, C, H, W] --> [B, H, W, C]
+        smooth_loss = depth_smoothness(depth.unsqueeze(dim=-1), ref_img_nhwc, 1.0)
+
+        top_vals = torch.min(reprojection_volume, dim=1)[0]
+        top_mask = (top_vals < 1e4).float()
         top_vals = torch.mul(top_vals, top_mask)
-        self.reconstr_loss = torch.mean(torch.sum(top_vals, dim=-1))   
+        self.reconstr_loss = torch.mean(top_vals) * valid
+        self.ssim_loss = ssim_loss * valid
+        self.smooth_loss = smooth_loss * valid
+        self.perceptual_loss = perceptual_loss * valid
         self.unsup_loss = self.args.wrecon * self.reconstr_loss + 6 * self.ssim_loss + 0.18 * self.smooth_loss + self.args.perc * self.perceptual_loss
         return self.unsup_loss
     
@@ -159,17 +162,32 @@ class UnsupLossMultiStage_l05(nn.Module):
         self.args = args
         self.unsup_loss = UnSupLoss_01(args)
 
-    def forward(self, data, outputs, epoch_idx, **kwargs):
+    @staticmethod
+    def ref_intrinsics_projs(stage_matrices, ref_inv):
+        """
+        K_ref @ E_src @ inverse(K_ref @ E_ref) of the source views, the photometric loss projects to every source
+        view with the intrinsics of the reference one
+        :param stage_matrices: (b, nview, 2, 4, 4) extrinsics and intrinsics of the stage
+        :param ref_inv: (b, 4, 4) inverse(K_ref @ E_ref) of the network ProjectionBundle
+        :return: (b, nview-1, 4, 4)
+        """
+        with torch.no_grad():
+            ref_intrinsics = torch.eye(4, dtype=ref_inv.dtype, device=ref_inv.device).repeat(ref_inv.size(0), 1, 1)
+            ref_intrinsics[:, :3, :3] = stage_matrices[:, 0, 1, :3, :3]
+            return torch.matmul(torch.matmul(ref_intrinsics.unsqueeze(1), stage_matrices[:, 1:, 0]), ref_inv.unsqueeze(1))
+
+    def forward(self, data, outputs, epoch_idx, pyramid, **kwargs):
         inputs = outputs
         imgs = data["center_imgs"]
-        cams = data["proj_matrices"]
+        proj_bundle = outputs["proj_bundle"]
         depth_loss_weights = self.args.dlossw
         total_loss = torch.tensor(0.0, dtype=torch.float32, device=imgs.device, requires_grad=False)
         scalar_outputs = {}
         for (stage_inputs, stage_key) in [(inputs[k], k) for k in inputs.keys() if "stage" in k]:
             stage_idx = int(stage_key.replace("stage", "")) - 1
             depth_est = stage_inputs["depth"]
-            depth_loss = self.unsup_loss(imgs, cams[stage_key], depth_est, stage_idx)
+            src_projs = self.ref_intrinsics_projs(data["proj_matrices"][stage_key], proj_bundle.ref_invs[stage_key])
+            depth_loss = self.unsup_loss(pyramid[stage_key]["imgs"], src_projs, depth_est)
             if depth_loss_weights is not None:
                 total_loss = total_loss + depth_loss_weights[stage_idx] * depth_loss
             else:
@@ -187,32 +205,19 @@ class ICCLossMultiStage(nn.Module):
         self.args = args
 
     # def forward(self, inputs, pseudo_depth, mask_ms, filter_mask, **kwargs):
-    def forward(self, data, outputs, epoch_idx, **kwargs):
+    def forward(self, data, outputs, epoch_idx, pyramid, **kwargs):
         if not "output2" in outputs: return torch.tensor(0.0, dtype=torch.float32, device=data["imgs"].device, requires_grad=False), {}
         inputs = outputs["output2"]
-        pseudo_depth = outputs["output1"]["depth"].detach()
-        filter_mask = inputs["filter_mask"] 
         depth_loss_weights = self.args.dlossw
-        total_loss = torch.tensor(0.0, dtype=torch.float32, device=pseudo_depth.device, requires_grad=False)
+        total_loss = torch.tensor(0.0, dtype=torch.float32, device=data["imgs"].device, requires_grad=False)
         scalar_outputs = {}
         for (stage_inputs, stage_key) in [(inputs[k], k) for k in inputs.keys() if "stage" in k]:
             stage_idx = int(stage_key.replace("stage", "")) - 1
 
             depth_est = stage_inputs["depth"]
 
-            pseudo_gt = pseudo_depth.unsqueeze(dim=1)
-            if stage_idx == 0:
-                pseudo_gt_t = F.interpolate(pseudo_gt, scale_factor=(0.25, 0.25))
-                filter_mask_t = F.interpolate(filter_mask, scale_factor=(0.25, 0.25))
-            elif stage_idx == 1:
-                pseudo_gt_t = F.interpolate(pseudo_gt, scale_factor=(0.5, 0.5))
-                filter_mask_t = F.interpolate(filter_mask, scale_factor=(0.5, 0.5))
-            else:
-                pseudo_gt_t = pseudo_gt
-                filter_mask_t = filter_mask
-            filter_mask_t = filter_mask_t[:, 0, :, :]
-            pseudo_gt_t = pseudo_gt_t.squeeze(dim=1)
-            mask = filter_mask_t > 0.5
+            pseudo_gt_t = pyramid[stage_key]["pseudo_depth"]
+            mask = pyramid[stage_key]["filter_mask"] > 0.5
             depth_loss = F.smooth_l1_loss(depth_est[mask], pseudo_gt_t[mask], reduction='mean')
             if depth_loss_weights is not None:
                 total_loss = total_loss + depth_loss_weights[stage_idx] * depth_loss
@@ -231,32 +236,16 @@ class SCCLossMultiStage(nn.Module):
         self.conf = args.mask_conf
         self.args = args
 
-    def forward(self, data, outputs, epoch_idx, **kwargs):
+    def forward(self, data, outputs, epoch_idx, pyramid, **kwargs):
         depth_loss_weights = self.args.dlossw
         total_loss = torch.tensor(0.0, dtype=torch.float32, device=data["center_imgs"].device, requires_grad=False)
         scalar_outputs = {}
-        photometric_confidence = outputs["output1"]["photometric_confidence"].clone().detach()
-        pseudo_depth = outputs["output1"]["depth"].clone().detach()
         output3 = outputs["output3"]
         w_scc = self.args.w_scc
         for stage_key in [k for k in output3.keys() if "stage" in k]:
             stage_idx = int(stage_key.replace("stage", "")) - 1     # 0 1 2
-            pseudo_gt = pseudo_depth.unsqueeze(dim=1)
-            photometric_confidence_tp = photometric_confidence.unsqueeze(dim=1)
-            if stage_idx == 0:
-                pseudo_gt_t = F.interpolate(pseudo_gt, scale_factor=(0.25, 0.25))
-                photometric_confidence_t = F.interpolate(photometric_confidence_tp, scale_factor=(0.25, 0.25))
-                mask_t = photometric_confidence_t > self.conf
-            elif stage_idx == 1:
-                pseudo_gt_t = F.interpolate(pseudo_gt, scale_factor=(0.5, 0.5))
-                photometric_confidence_t = F.interpolate(photometric_confidence_tp, scale_factor=(0.5, 0.5))
-                mask_t = photometric_confidence_t > self.conf
-            else:
-                pseudo_gt_t = pseudo_gt
-                photometric_confidence_t = photometric_confidence_tp
-                mask_t = photometric_confidence_t > self.conf
-            pseudo_gt_t = pseudo_gt_t.squeeze(dim=1)
-            mask_t = mask_t.squeeze(dim=1)
+            pseudo_gt_t = pyramid[stage_key]["pseudo_depth"]
+            mask_t = pyramid[stage_key]["confidence"] > self.conf
             if torch.sum(mask_t.type(torch.float32)) == 0:
                 depth_loss = torch.tensor(0.0, dtype=torch.float32, device=data["center_imgs"].device)
             else:
@@ -10,6 +10,14 @@ parser.add_argument("--sample1", type=dict, nargs='+', default={"num_hypotheses"
 parser.add_argument("--sample2", type=dict, nargs='+', default={"num_hypotheses":32, "interval_ratio":2})
 parser.add_argument("--sample3", type=dict, nargs='+', default={"num_hypotheses":8, "interval_ratio":1})
 parser.add_argument("--group", type=int, default=8)
+parser.add_argument("--warp_chunk", type=int, default=0, help="source views warped per grid_sample call, 0 to derive it from --warp_mb")
+parser.add_argument("--warp_mb", type=float, default=0,
+                    help="memory bound of the source views warped at once, 0 for half of the free device memory, at least one view is warped")
+parser.add_argument("--agg_mode", type=str, default="sum", choices=["sum", "correlation"],
+                    help="correlation accumulates per view group-wise correlations and never keeps a full channel volume")
+parser.add_argument("--no_batch_views", action="store_true", help="run the feature network once per view")
+parser.add_argument("--view_bn", type=str, default="per_view", choices=["per_view", "shared"],
+                    help="batchnorm statistics of the batched views in train mode, per_view matches the per view loop")
 
 # dataset
 parser.add_argument("--img_size", type=int, nargs='+', default=[512, 640])
@@ -22,6 +30,12 @@ parser.add_argument('--numdepth', type=int, default=192, help='the number of dep
 parser.add_argument('--interval_scale', type=float, default=1.06, help='the number of depth values')
 parser.add_argument("--nviews", type=int, default=5)
 parser.add_argument("--inverse_depth", action="store_true")
+parser.add_argument("--image_store", type=str, default=None, help="pre-decoded image store, defaults to {datapath}/image_store")
+parser.add_argument("--gt_cache", type=str, default=None, help="depth/mask pyramid cache, defaults to {datapath}/gt_cache")
+parser.add_argument("--gt_cache_size", type=int, default=-1,
+                    help="depth/mask pyramids kept in memory per worker, 0 to disable, -1 for the ref views of a scan")
+parser.add_argument("--sampler", type=str, default="random", choices=["random", "locality"], help="training sample order")
+parser.add_argument("--sampler_window", type=int, default=16, help="(light, ref_view) block size of the locality sampler")
 
 # training and val
 parser.add_argument("--val", action="store_true")
@@ -45,6 +59,7 @@ parser.add_argument('--max_w_icc', type=float, default=0.32)
 parser.add_argument('--w_scc', type=float, default=0.01)
 parser.add_argument('--mask_conf', type=float, default=0.95)
 parser.add_argument('--p_icc', type=float, default=0.1)
+parser.add_argument('--compile_loss', action='store_true', help='run the photometric penalty through torch.compile')
 
 
 # log
@@ -62,10 +77,34 @@ parser.add_argument('--conf', type=float, default=0.8, help='prob confidence, fo
 parser.add_argument('--thres_view', type=int, default=3, help='threshold of num view, for pcd')
 parser.add_argument('--depth_thres', type=float, default=0.001, help='depth_thres for pcd')
 parser.add_argument('--img_dist_thres', type=float, default=0.75, help='depth_thres for pcd')
+parser.add_argument('--feature_cache_mb', type=float, default=0, help='memory bound of the test time view feature cache, 0 to disable')
+parser.add_argument('--feature_cache_fp16', action='store_true', help='store the cached view features in fp16')
+parser.add_argument('--tile_mb', type=float, default=0, help='memory budget of a cost volume tile at test time, 0 to disable tiling')
+parser.add_argument('--fuse_bn', action='store_true', help='fold batchnorm into the convolutions at test time')
+parser.add_argument('--fuse_bn_tol', type=float, default=1e-2, help='largest accepted depth difference of the fused network on the first test batch')
+parser.add_argument('--export', type=str, default=None, help='with --test, save the captured test path to this file and exit')
+parser.add_argument('--export_format', type=str, default="torchscript", choices=["torchscript", "torch_export", "onnx"],
+                    help='artifact format of --export, use a .pt, .pt2 or .onnx file respectively')
+parser.add_argument('--exported', type=str, default=None, help='run the test path from an artifact of --export instead of the network and --resume')
+parser.add_argument('--quantize', type=str, default=None,
+                    help='with --val and --no_cuda, save an int8 checkpoint to this file and compare it to fp32 on the val set')
+parser.add_argument('--quant_backend', type=str, default="fbgemm", choices=["fbgemm", "x86", "qnnpack"],
+                    help='int8 kernels of --quantize, qnnpack on arm hosts, stored in the int8 checkpoint')
+parser.add_argument('--calib_datapath', type=str, default="/media/data3/code/wqj/dtu_test/", help='general_eval root of the int8 calibration')
+parser.add_argument('--calib_list', type=str, default="datasets/lists/dtu/test.txt", help='int8 calibration scenes')
+parser.add_argument('--calib_scenes', type=int, default=3, help='number of calibration scenes')
+parser.add_argument('--calib_batches', type=int, default=8, help='calibration batches per scene')
 
 
 # device and distributed
 parser.add_argument("--no_cuda", action="store_true")
+parser.add_argument("--amp", type=str, default="none", choices=["none", "fp16", "bf16"],
+                    help="autocast the network, fp16 is only used on cuda, geometry, regression and losses stay in fp32")
+parser.add_argument("--amp_benchmark", action="store_true", help="with --val, compare the val depth errors and time of --amp to fp32")
+parser.add_argument("--num_threads", type=int, default=0, help="intra-op cpu threads, 0 for the torch default")
+parser.add_argument("--num_interop_threads", type=int, default=0, help="inter-op cpu threads, 0 for the torch default")
+parser.add_argument("--numa_node", type=int, default=-1, help="pin the process to the cpus of this numa node, -1 to disable")
+parser.add_argument("--stage_latency", action="store_true", help="report the per-stage latency of the test path")
 parser.add_argument("--local_rank", type=int, default=0)
 parser.add_argument('--dist-url', default='env://', help='url used to set up distributed training')
 parser.add_argument("--sync_bn", action="store_true")
@@ -1,10 +1,13 @@
 import cv2
+import copy
 import time
 import progressbar
 import torch.backends.cudnn as cudnn
 from tensorboardX import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel
 from networks.domvsnet import DOMVSNet
+from networks.module import fuse_conv_bn
+from networks.export import export_test_graph, ExportedTestGraph
 from datasets import get_loader
 from tools import *
 from loss import MVSLoss
@@ -17,10 +20,19 @@ class Model:
 
         cudnn.benchmark = True
         init_distributed_mode(args)
+        setup_cpu_threads(args)
 
         self.args = args
         self.device = torch.device("cpu" if self.args.no_cuda or not torch.cuda.is_available() else "cuda")
+        if self.args.test and self.args.exported:
+            # the artifact holds the weights, neither the network nor its checkpoint is built
+            self.network = ExportedTestGraph(self.args.exported, self.device, self.args.num_stage)
+            self.network_without_ddp = None
+            self.reference_network = None
+            return
         self.network = DOMVSNet(args).to(self.device)
+        if self.args.test and self.args.stage_latency:
+            self.network.model.stage_timer = StageTimer(self.device)
 
         if self.args.distributed and self.args.sync_bn:
             self.network = torch.nn.SyncBatchNorm.convert_sync_batchnorm(self.network)
@@ -29,10 +41,12 @@ class Model:
             self.optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, self.network.parameters()), lr=args.lr,
                                               weight_decay=args.wd)
             self.lr_scheduler = get_schedular(self.optimizer, self.args)
+            # fp16 gradients are scaled, bf16 has the exponent range of fp32
+            self.scaler = torch.cuda.amp.GradScaler(enabled=self.args.amp == "fp16" and self.device.type == "cuda")
             self.train_loader, self.train_sampler = get_loader(args, args.trainlist, "train")
 
         if not self.args.test:
-            self.loss_func = MVSLoss(args)
+            self.loss_func = MVSLoss(args).to(self.device)
             self.val_loader, self.val_sampler = get_loader(args, args.testlist, "val")
             if is_main_process():
                 self.writer = SummaryWriter(log_dir=args.log_dir, comment="Record network info")
@@ -48,14 +62,39 @@ class Model:
                 self.args.start_epoch = checkpoint["epoch"] + 1
                 self.optimizer.load_state_dict(checkpoint["optimizer"])
                 self.lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+            if "int8" in checkpoint:
+                # int8 checkpoints hold the quantized weights, the network is converted before loading them
+                assert self.device.type == "cpu", \
+                    "{} is an int8 checkpoint, its quantized kernels run on the cpu only, use --no_cuda".format(self.args.resume)
+                self.network_without_ddp.eval()
+                # the kernels of the backend the weights were packed for
+                self.network_without_ddp.model.prepare_int8(checkpoint["quant_backend"])
+                self.network_without_ddp.model.convert_int8()
             self.network_without_ddp.load_state_dict(checkpoint["model"])
+
+        # unfused copy kept to check the fused outputs on the first test batch
+        self.reference_network = None
+        if self.args.test and self.args.fuse_bn:
+            self.network_without_ddp.eval()
+            self.reference_network = copy.deepcopy(self.network_without_ddp)
+            self.reference_network.model.stage_timer = None
+            fuse_conv_bn(self.network_without_ddp)
             
         self.args = args
 
     def main(self):
+        if self.args.quantize:
+            self.quantize()
+            return
+        if self.args.amp_benchmark:
+            self.benchmark_amp()
+            return
         if self.args.val:
             self.validate()
             return
+        if self.args.test and self.args.export:
+            self.export()
+            return
         if self.args.test:
             self.test()
             return
@@ -63,7 +102,7 @@ class Model:
 
     def train(self):
         for epoch in range(self.args.start_epoch, self.args.start_epoch + self.args.epochs):
-            if self.args.distributed:
+            if hasattr(self.train_sampler, "set_epoch"):
                 self.train_sampler.set_epoch(epoch)
             self.train_epoch(epoch)
             if is_main_process():
@@ -92,15 +131,17 @@ class Model:
         avg_scalars = DictAverageMeter()
 
         for batch, data in enumerate(self.train_loader):
-            data = tocuda(data)
+            data = todevice(data, self.device)
 
-            outputs = self.network(data, "train", epoch)
+            with autocast(self.device, self.args.amp):
+                outputs = self.network(data, "train", epoch)
 
             loss, losses= self.loss_func(data, outputs, epoch)
 
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
             self.lr_scheduler.step(epoch + batch / len(self.train_loader))
 
@@ -161,9 +202,10 @@ class Model:
         avg_scalars = DictAverageMeter()
 
         for batch, data in enumerate(self.val_loader):
-            data = tocuda(data)
+            data = todevice(data, self.device)
 
-            outputs = self.network(data,"val")
+            with autocast(self.device, self.args.amp):
+                outputs = self.network(data,"val")
             
             loss, losses = self.loss_func(data, outputs, epoch)
 
@@ -210,13 +252,94 @@ class Model:
         if is_main_process():
             pbar.finish()
 
+    def val_metrics(self, network, amp="none"):
+        """ mean depth errors and time of network on the val set """
+        avg_scalars = DictAverageMeter()
+        for data in self.val_loader:
+            data = todevice(data, self.device)
+            start_time = time.time()
+            with autocast(self.device, amp):
+                outputs = network(data, "test")
+            if self.device.type == "cuda":
+                torch.cuda.synchronize()
+            end_time = time.time()
+            gt_depth = data["depth"]["stage{}".format(self.args.num_stage)]
+            mask = data["mask"]["stage{}".format(self.args.num_stage)] > 0.5
+            avg_scalars.update(tensor2float({"abs_depth_error": AbsDepthError_metrics(outputs["depth"], gt_depth, mask),
+                                             "thres2mm_error": Thres_metrics(outputs["depth"], gt_depth, mask, 2),
+                                             "thres4mm_error": Thres_metrics(outputs["depth"], gt_depth, mask, 4),
+                                             "thres8mm_error": Thres_metrics(outputs["depth"], gt_depth, mask, 8),
+                                             "time": end_time - start_time}))
+        return avg_scalars.avg_data
+
+    @torch.no_grad()
+    def benchmark_amp(self):
+        """ depth errors and time of the val set in float32 and in the --amp mode, and their deltas """
+        self.network.eval()
+        results = {}
+        for amp in ["none", self.args.amp]:
+            results[amp] = self.val_metrics(self.network, amp)
+            print(amp, results[amp])
+        print("{} - fp32".format(self.args.amp), {k: v - results["none"][k] for k, v in results[self.args.amp].items()})
+
+    @torch.no_grad()
+    def quantize(self):
+        """
+        int8 post-training quantization of the features and the cost regularization: calibrate on the first
+        --calib_scenes general_eval scenes, save the int8 checkpoint and report the val depth errors and time of
+        the fp32 and int8 networks, and their deltas
+        """
+        assert self.device.type == "cpu", "the int8 kernels run on the cpu, use --no_cuda"
+        self.network.eval()
+        networks = {"fp32": copy.deepcopy(self.network_without_ddp)}
+        self.network_without_ddp.model.prepare_int8(self.args.quant_backend)
+
+        calib_args = copy.copy(self.args)
+        calib_args.dataset_name, calib_args.datapath = "general_eval", self.args.calib_datapath
+        with open(self.args.calib_list) as f:
+            scenes = [line.rstrip() for line in f.readlines()][:self.args.calib_scenes]
+        for scene in scenes:
+            calib_loader, _ = get_loader(calib_args, [scene], "test")
+            for batch_idx, data in enumerate(calib_loader):
+                if batch_idx >= self.args.calib_batches:
+                    break
+                self.network(todevice(data, self.device), "test")
+            print(scene, "calibrated")
+
+        self.network_without_ddp.model.convert_int8()
+        torch.save({"model": self.network_without_ddp.state_dict(), "int8": True,
+                    "quant_backend": self.args.quant_backend}, self.args.quantize)
+        print("saved the int8 checkpoint to {}".format(self.args.quantize))
+
+        networks["int8"] = self.network
+        results = {}
+        for name, network in networks.items():
+            results[name] = self.val_metrics(network)
+            print(name, results[name])
+        print("int8 - fp32", {k: v - results["fp32"][k] for k, v in results["int8"].items()})
+
+    @torch.no_grad()
+    def export(self):
+        """ capture the test path on the first test batch, the artifact is fixed to its batch shape """
+        assert not self.args.exported, "--export captures the network of --resume, not an --exported artifact"
+        self.network.eval()
+        with open(self.args.testlist) as f:
+            scene = f.readline().rstrip()
+        TestImgLoader, _ = get_loader(self.args, [scene], "test")
+        data = todevice(next(iter(TestImgLoader)), self.device)
+        depth_diff, confidence_diff = export_test_graph(self.network_without_ddp.model, data, self.args.export,
+                                                        self.args.export_format)
+        print("exported the {} test path to {}, input size {}, max depth difference {}, max confidence difference {}"
+              .format(self.args.export_format, self.args.export, tuple(data["imgs"].shape), depth_diff, confidence_diff))
+
     @torch.no_grad()
     def test(self):
         inv_normalize = transforms.Normalize(
         mean=[-0.485/0.229, -0.456/0.224, -0.406/0.255],
         std=[1/0.229, 1/0.224, 1/0.255]
         )
-        self.network.eval()
+        if self.network_without_ddp is not None:
+            self.network.eval()
 
         with open(self.args.testlist) as f:
             content = f.readlines()
@@ -230,10 +353,19 @@ class Model:
             TestImgLoader, _ = get_loader(self.args, [scene], "test")
 
             for batch_idx, data in enumerate(TestImgLoader):
-                data_cuda = tocuda(data)
+                data_cuda = todevice(data, self.device)
                 start_time = time.time()
-                outputs = self.network(data_cuda,"test")
+                with autocast(self.device, self.args.amp):
+                    outputs = self.network(data_cuda,"test")
                 end_time = time.time()
+                if self.reference_network is not None:
+                    depth_diff = (self.reference_network(data_cuda, "test")["depth"] - outputs["depth"]).abs().max().item()
+                    # the unfused copy is only needed for this check
+                    self.reference_network = None
+                    if depth_diff > self.args.fuse_bn_tol:
+                        raise RuntimeError("the fused network differs from the unfused one, max depth difference {} "
+                                           "(tolerance {})".format(depth_diff, self.args.fuse_bn_tol))
+                    print("max depth difference of the fused network: {}".format(depth_diff))
                 outputs = tensor2numpy_str(outputs)
                 del data_cuda
                 filenames = data["filename"]
@@ -274,7 +406,16 @@ class Model:
                     img = np.clip(np.transpose(img, (1, 2, 0)) * 255, 0, 255).astype(np.uint8)
                     img_bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
                     cv2.imwrite(img_filename, img_bgr)
-                    
+
+            if self.network_without_ddp is not None:
+                feature_cache = self.network_without_ddp.model.feature_cache
+                if feature_cache is not None:
+                    print(scene, "feature cache", feature_cache.stats())
+                    feature_cache.clear()
+                stage_timer = self.network_without_ddp.model.stage_timer
+                if stage_timer is not None:
+                    print(scene, "latency ms", stage_timer.report())
+                    stage_timer.clear()
             torch.cuda.empty_cache()
 
         # step2. filter saved depth maps with photometric confidence maps and geometric constraints
@@ -2,8 +2,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+import contextlib
 from tools import *
 from .module import *
+from .feature_cache import FeatureCache
 
 Align_Corners_Range = False
 
@@ -80,6 +82,8 @@ class FPNFeature(nn.Module):
             self.out_channels.append(base_channels)
         self.ca = ChannelAttention(final_chs)
         self.sa = SpatialAttention()
+        if not args.no_batch_views and args.view_bn == "per_view":
+            convert_view_bn(self)
 
     def forward(self, x):
         conv0 = self.conv0(x)
@@ -117,6 +121,15 @@ class FPNFeature(nn.Module):
 
         return outputs
 
+    def forward_views(self, imgs):
+        """ run all views in one call, (b, v, 3, h, w) -> [ref_feat, src_feat1, ...] """
+        b, v = imgs.shape[:2]
+        set_bn_views(self, v)
+        outputs = self(imgs.reshape(b * v, *imgs.shape[2:]))
+        set_bn_views(self, 1)
+        outputs = {stage: feat.view(b, v, *feat.shape[1:]) for stage, feat in outputs.items()}
+        return [{stage: feat[:, view_idx] for stage, feat in outputs.items()} for view_idx in range(v)]
+
 class InitSampler(nn.Module):
     def __init__(self, sample, **kwargs):
         super(InitSampler, self).__init__()
@@ -130,14 +143,8 @@ class InitSampler(nn.Module):
         last_depth_max = last_depth[:, -1]
         new_interval = (last_depth_max - last_depth_min) / (self.num_hypotheses - 1)  # (B, )
 
-        depth_hypotheses = last_depth_min.unsqueeze(1) + (
-                torch.arange(0, self.num_hypotheses, device=last_depth.device, dtype=last_depth.dtype,
-                             requires_grad=False).reshape(1, -1) * new_interval.unsqueeze(1))  # (B, D)
-
-        # (B, D, H, W)
-        depth_hypotheses = depth_hypotheses.unsqueeze(-1).unsqueeze(-1).repeat(1, 1, shape[0], shape[1])
-
-        return depth_hypotheses
+        # (B, D), the same for every pixel of the (H, W) view
+        return DepthHypotheses(last_depth_min, new_interval, self.num_hypotheses, shape)
 
 class UniformSampler(nn.Module):
     def __init__(self, sample, **kwargs):
@@ -151,66 +158,110 @@ class UniformSampler(nn.Module):
         depth_interval = self.interval_ratio * interval_base
 
         last_depth_min = (last_depth - self.num_hypotheses / 2 * depth_interval)  # (B, H, W)
-        last_depth_max = (last_depth + self.num_hypotheses / 2 * depth_interval)
 
-        new_interval = (last_depth_max - last_depth_min) / (self.num_hypotheses - 1)  # (B, H, W)
+        # the range spans num_hypotheses * depth_interval everywhere, only its start varies per pixel
+        new_interval = self.num_hypotheses * depth_interval / (self.num_hypotheses - 1) \
+                       * last_depth.new_ones(last_depth.size(0))  # (B, )
 
-        depth_hypotheses = last_depth_min.unsqueeze(1) + (torch.arange(0, self.num_hypotheses, device=last_depth.device,
-                                                                       dtype=last_depth.dtype, requires_grad=False).reshape(1, -1, 1, 1)
-                                                          * new_interval.unsqueeze(1))
+        # bilinear upsampling is linear, upsampling the start is the same as upsampling every hypothesis
+        last_depth_min = F.interpolate(last_depth_min.unsqueeze(1), shape, mode='bilinear', align_corners=False)
 
-        depth_hypotheses = F.interpolate(depth_hypotheses, shape, mode='bilinear', align_corners=False)
-
-        return depth_hypotheses
+        return DepthHypotheses(last_depth_min.squeeze(1), new_interval, self.num_hypotheses, shape)
     
 class GroupWiseAgg(nn.Module):
     def __init__(self, args, **kwargs):
         super(GroupWiseAgg, self).__init__()
         self.G = args.group
+        self.warp_chunk = args.warp_chunk
+        self.warp_mb = args.warp_mb
+        self.agg_mode = args.agg_mode
 
         self.out_channels = self.G
 
-    def forward(self, features, proj_matrices, depth_hypotheses, **kwargs):
+    def chunk_size(self, b, c, num_depth, h, w, num_src, device):
+        """
+        source views warped per grid_sample call, all of them when they fit in warp_mb (half of the free memory of
+        device when it is 0) and fewer otherwise, unless warp_chunk is given
+        """
+        if self.warp_chunk > 0:
+            return min(self.warp_chunk, num_src)
+        budget_mb = self.warp_mb if self.warp_mb > 0 else free_memory_mb(device) / 2
+        # float32 bytes per warped view: the warped features, the sampling grid and the projected points
+        view_bytes = 4 * b * num_depth * h * w * (c + 2 + 3)
+        return int(min(max(budget_mb * 1024 * 1024 // view_bytes, 1), num_src))
+
+    def forward(self, features, src_projs, depth_hypotheses, roi=None, chunk=None, **kwargs):
         """
         :param features: [ref_fea, src_fea1, src_fea2, ...], fea shape: (b, c, h, w)
-        :param proj_matrices: (b, nview, ...) [ref_proj, src_proj1, src_proj2, ...]
-        :param depth_hypotheses: (b, ndepth, h, w)
+        :param src_projs: (b, nview-1, 4, 4) src_proj @ inverse(ref_proj) of every source view
+        :param depth_hypotheses: DepthHypotheses of the roi when it is given
+        :param roi: (y0, x0, h, w) window of the reference view, the whole view when not given
+        :param chunk: source views warped at once, chunk_size when not given
         :return: matching cost volume (b, c, ndepth, h, w)
         """
-        ref_feature, src_features = features[0], features[1:]
-        proj_matrices = torch.unbind(proj_matrices, 1)  # to list
-        ref_proj, src_projs = proj_matrices[0], proj_matrices[1:]
+        ref_feature = features[0]
+        y0, x0 = roi[:2] if roi is not None else (0, 0)
+        if roi is not None:
+            ref_feature = ref_feature[:, :, y0: y0 + roi[2], x0: x0 + roi[3]]
+        src_features = torch.stack(features[1:], 1)  # (b, nview-1, c, h, w)
 
         num_views = len(features)
-        num_depth = depth_hypotheses.shape[1]
-
-        ref_volume = ref_feature.unsqueeze(2).repeat(1, 1, num_depth, 1, 1)
-        b, c, d, h, w = ref_volume.shape
-        ref_volume = ref_volume.view(b, self.G, c // self.G, d, h, w)
+        num_depth = depth_hypotheses.num
+        b, c, h, w = ref_feature.shape
+
+        if self.agg_mode == "correlation":
+            # reduced against the warped views by einsum, never broadcast to a full volume
+            ref_volume = ref_feature.view(b, self.G, c // self.G, h, w)
+        else:
+            ref_volume = ref_feature.unsqueeze(2).repeat(1, 1, num_depth, 1, 1)
+            ref_volume = ref_volume.view(b, self.G, c // self.G, num_depth, h, w)
         volume_sum = None
+        volume_correlation = None
 
-        for src_fea, src_proj in zip(src_features, src_projs):
-            # warpped features
-            src_proj_new = src_proj[:, 0].clone()
-            src_proj_new[:, :3, :4] = torch.matmul(src_proj[:, 1, :3, :3], src_proj[:, 0, :3, :4])
-            ref_proj_new = ref_proj[:, 0].clone()
-            ref_proj_new[:, :3, :4] = torch.matmul(ref_proj[:, 1, :3, :3], ref_proj[:, 0, :3, :4])
-            warped_volume = homo_warping(src_fea, src_proj_new, ref_proj_new, depth_hypotheses)
-
-            warped_volume = warped_volume.view_as(ref_volume)
-            if volume_sum is None:
-                volume_sum = warped_volume
+        with torch.no_grad():
+            # the pixel grid is shared by all source views
+            xyz = pixel_grid(h, w, ref_feature.device, y0, x0)
+
+        if chunk is None:
+            chunk = self.chunk_size(b, c, num_depth, h, w, num_views - 1, ref_feature.device)
+        for view_idx in range(0, num_views - 1, chunk):
+            # warpped features of up to chunk source views at once
+            warped_volume = homo_warping_views(src_features[:, view_idx: view_idx + chunk],
+                                               src_projs[:, view_idx: view_idx + chunk], depth_hypotheses, xyz,
+                                               (y0, x0, h, w))
+            if self.agg_mode == "correlation":
+                # group-wise correlation of each view, only (b, g, d, h, w) is accumulated
+                warped_volume = warped_volume.view(b, -1, self.G, c // self.G, num_depth, h, w)
+                # sum over the views and the group channels in one contraction, (b, g, d, h, w)
+                correlation = torch.einsum("bvgcdhw,bgchw->bgdhw", warped_volume, ref_volume) / (c // self.G)
+                if volume_correlation is None:
+                    volume_correlation = correlation
+                else:
+                    volume_correlation = volume_correlation + correlation
+                del correlation
             else:
-                volume_sum = volume_sum + warped_volume
+                warped_volume = warped_volume.sum(1).view_as(ref_volume)
+                if volume_sum is None:
+                    volume_sum = warped_volume
+                else:
+                    volume_sum = volume_sum + warped_volume
 
             del warped_volume
 
-        volume_correlation  = torch.mean(volume_sum * ref_volume, dim=2) / (num_views - 1)  # (b, g, d, h, w)
+        if self.agg_mode == "correlation":
+            volume_correlation = volume_correlation / (num_views - 1)
+        else:
+            volume_correlation  = torch.mean(volume_sum * ref_volume, dim=2) / (num_views - 1)  # (b, g, d, h, w)
 
         # cost_volume = {"volume_correlation":volume_correlation}
         return volume_correlation
 
 class DLANetReg(nn.Module):
+    # the receptive field radius is 103 px (mostly the dilated LKA convs), tiles overlap by it rounded up to the
+    # total stride of the network so that tiles start on the same downsampling grid as the whole image
+    tile_halo = 104
+    tile_align = 8
+
     def __init__(self, args, in_channels=8, **kwargs):
         super(DLANetReg, self).__init__()
 
@@ -234,9 +285,9 @@ class DLANetReg(nn.Module):
         self.conv11 = Deconv3d(base_channels * 2, base_channels * 1, stride=2, padding=1, output_padding=1)
 
         self.prob = nn.Conv3d(base_channels, 1, 3, stride=1, padding=1, bias=False)
-        # self.block64 = LKA_Attention3d(d_model=64).cuda(0)
-        self.block32 = LKA_Attention3d(d_model=32).cuda(0)
-        self.block16 = LKA_Attention3d(d_model=16).cuda(0)
+        # self.block64 = LKA_Attention3d(d_model=64)
+        self.block32 = LKA_Attention3d(d_model=32)
+        self.block16 = LKA_Attention3d(d_model=16)
     def forward(self, x, **kwargs):
         y = x # [1, 8, 48, 128, 160]
         conv0 = self.conv0(x)
@@ -257,30 +308,31 @@ class RegressionDepth(nn.Module):
         super(RegressionDepth, self).__init__()
 
     def forward(self, cost_reg, depth_hypotheses, **kwargs):
-
-        prob_volume_pre = cost_reg.squeeze(1)  # (b, d, h, w)
-
-        prob_volume = F.softmax(prob_volume_pre, dim=1)  # (b, ndepth, h, w)
-        depth = depth_regression(prob_volume, depth_hypotheses=depth_hypotheses)  # (b, h, w)
-
-        num_depth = prob_volume.shape[1]
-
-        with torch.no_grad():
-            # photometric confidence
-            prob_volume_sum4 = 4 * F.avg_pool3d(F.pad(prob_volume.unsqueeze(1), pad=(0, 0, 0, 0, 1, 2)), (4, 1, 1), stride=1,
-                                                padding=0).squeeze(1)
-            depth_index = depth_regression(prob_volume,
-                                           depth_hypotheses=torch.arange(num_depth, device=prob_volume.device,
-                                                                         dtype=torch.float)).long()
-            depth_index = depth_index.clamp(min=0, max=num_depth - 1)
-            photometric_confidence = torch.gather(prob_volume_sum4, 1, depth_index.unsqueeze(1)).squeeze(1)
-            pv = torch.where(prob_volume <= 0, torch.ones_like(prob_volume)*1e-5, prob_volume)
-            distribution_consistency = (np.log(pv.shape[1]) - torch.sum(-pv * torch.log(pv), dim=1)) / np.log(pv.shape[1])
-            # photometric_confidence[distribute_quality > 0.9] = 0
-
-        return {"depth": depth, "photometric_confidence": photometric_confidence, "prob_volume": prob_volume,
-                "depth_hypotheses": depth_hypotheses, "depth_mode": "regression",
-                "distribution_consistency": distribution_consistency}
+        # softmax and regression stay in float32 under autocast
+        with float32_region():
+            prob_volume_pre = cost_reg.squeeze(1).float()  # (b, d, h, w)
+
+            prob_volume = F.softmax(prob_volume_pre, dim=1)  # (b, ndepth, h, w)
+            # regression of the hypothesis index, mapped to a depth without expanding the hypotheses
+            index = depth_regression(prob_volume, depth_hypotheses=depth_hypotheses.steps())  # (b, h, w)
+            depth = depth_hypotheses.regression(index)
+
+            num_depth = prob_volume.shape[1]
+
+            with torch.no_grad():
+                # photometric confidence
+                prob_volume_sum4 = 4 * F.avg_pool3d(F.pad(prob_volume.unsqueeze(1), pad=(0, 0, 0, 0, 1, 2)), (4, 1, 1), stride=1,
+                                                    padding=0).squeeze(1)
+                depth_index = index.detach().long()
+                depth_index = depth_index.clamp(min=0, max=num_depth - 1)
+                photometric_confidence = torch.gather(prob_volume_sum4, 1, depth_index.unsqueeze(1)).squeeze(1)
+                pv = torch.where(prob_volume <= 0, torch.ones_like(prob_volume)*1e-5, prob_volume)
+                distribution_consistency = (np.log(pv.shape[1]) - torch.sum(-pv * torch.log(pv), dim=1)) / np.log(pv.shape[1])
+                # photometric_confidence[distribute_quality > 0.9] = 0
+
+            return {"depth": depth, "photometric_confidence": photometric_confidence, "prob_volume": prob_volume,
+                    "depth_mode": "regression",
+                    "distribution_consistency": distribution_consistency}
 
 class CasMVSNet(nn.Module):
     def __init__(self, args):
@@ -292,8 +344,140 @@ class CasMVSNet(nn.Module):
         self.depth_head = nn.ModuleList([RegressionDepth(args), RegressionDepth(args), RegressionDepth(args)])
         self.num_stage = args.num_stage
         self.args = args
-
-    def forward(self, data, icc=False, scc=False, epoch=0):
+        # features of the views seen in earlier test samples of the same scene
+        self.feature_cache = FeatureCache(args.feature_cache_mb, args.feature_cache_fp16) \
+            if args.test and args.feature_cache_mb > 0 else None
+        # StageTimer of the test path, set by Model when the per-stage latency is reported
+        self.stage_timer = None
+        # stages whose tiles exceed args.tile_mb, warned once
+        self.tile_warned = set()
+
+    def timed(self, name):
+        if self.stage_timer is None or self.training:
+            return contextlib.nullcontext()
+        return self.stage_timer.time(name)
+
+    def int8_modules(self):
+        """ the modules quantized to int8, warping, the prob convs and the regression stay in float """
+        return [self.feature] + list(self.regularization)
+
+    def prepare_int8(self, backend):
+        for module in self.int8_modules():
+            prepare_int8(module, backend)
+
+    def convert_int8(self):
+        for module in self.int8_modules():
+            convert_int8(module)
+
+    def extract_features(self, imgs):
+        """ (b, v, 3, h, w) -> [ref_feat, src_feat1, ...] """
+        # SyncBatchNorm normalizes the folded views together, per view statistics need the per view loop in train mode
+        sync_per_view = self.training and self.args.distributed and self.args.sync_bn and self.args.view_bn == "per_view"
+        if not self.args.no_batch_views and not sync_per_view:
+            return self.feature.forward_views(imgs)
+        return [self.feature(imgs[:, nview_idx]) for nview_idx in range(imgs.size(1))]
+
+    def per_view_bn(self):
+        """ whether the features of a view depend on that view only, batchnorm never mixes views in eval mode """
+        if not self.training:
+            return True
+        if self.args.distributed and self.args.sync_bn:
+            # synchronized statistics mix the views of the other processes
+            return False
+        return self.args.no_batch_views or self.args.view_bn == "per_view"
+
+    def scc_features(self, data, features):
+        """
+        features of data["imgs_scc"], reusing the clean pass features of the views it already has
+        :param features: clean pass features of data["imgs"], not detached so the scc loss still reaches the FPN
+        """
+        if not self.per_view_bn():
+            # the batch statistics mix views, features of another view set are not the same
+            return self.extract_features(data["imgs_scc"])
+
+        view_ids = torch.stack(data["view_ids"], 1).tolist()
+        view_ids_scc = torch.stack(data["view_ids_scc"], 1).tolist()
+        num_views = len(view_ids_scc[0])
+        # a slot is reused when it holds the same view as a clean slot for every sample of the batch, batchnorm
+        # statistics are per view then and the features are identical to recomputed ones
+        src_slots = []
+        for slot in range(num_views):
+            matches = [k for k in range(len(view_ids[0]))
+                       if all(ids[k] == ids_scc[slot] for ids, ids_scc in zip(view_ids, view_ids_scc))]
+            src_slots.append(matches[0] if matches else None)
+
+        new_slots = [slot for slot in range(num_views) if src_slots[slot] is None]
+        new_features = self.extract_features(data["imgs_scc"][:, new_slots]) if new_slots else []
+        new_features = dict(zip(new_slots, new_features))
+        return [features[src_slots[slot]] if src_slots[slot] is not None else new_features[slot]
+                for slot in range(num_views)]
+
+    def tile_size(self, stage_idx, features_stage, num_depth):
+        """
+        side of the tile cores and source views warped at once per tile, so that the aggregation and regularization
+        of a tile stay within args.tile_mb. Fewer views are warped at once before the core gets smaller than the
+        halo, the smallest such tile is used with a warning when even one view at a time doesn't fit.
+        """
+        regularization = self.regularization[stage_idx]
+        aggregation = self.aggregation[stage_idx]
+        halo, align = regularization.tile_halo, regularization.tile_align
+        b, c = features_stage[0].shape[:2]
+        num_src = len(features_stage) - 1
+        # rough float32 bytes per pixel: reference and summed volumes and regularization activations, and the
+        # warped features, sampling grid and projected points of one source view
+        fixed_bytes = 4 * b * num_depth * (2 * c + self.args.group + 4 * self.args.base_channels)
+        view_bytes = 4 * b * num_depth * (c + 2 + 3)
+        budget = self.args.tile_mb * 1024 * 1024
+        min_core = (halo // align + 1) * align
+
+        for chunk in range(num_src, 0, -1):
+            side = int((budget / (fixed_bytes + chunk * view_bytes)) ** 0.5)
+            core = (side - 2 * halo) // align * align
+            # the chunk the aggregation would pick for this tile bounds it as well
+            max_chunk = aggregation.chunk_size(b, c, num_depth, side, side, num_src, features_stage[0].device)
+            if core >= min_core and chunk <= max_chunk:
+                return core, chunk
+
+        side = min_core + 2 * halo
+        if stage_idx not in self.tile_warned:
+            self.tile_warned.add(stage_idx)
+            print("warning: --tile_mb {} can't hold a stage{} tile core larger than its halo, {:.0f} MB tiles are used"
+                  .format(self.args.tile_mb, stage_idx + 1, side * side * (fixed_bytes + view_bytes) / 1024 / 1024))
+        return min_core, 1
+
+    def tiled_cost_reg(self, stage_idx, features_stage, src_projs, depth_hypotheses):
+        """
+        aggregation and regularization of a stage tile by tile, for images whose cost volume doesn't fit in memory.
+        The tiles overlap by the receptive field of the regularization, so the stitched volume is the same as the
+        one of the whole image.
+        """
+        regularization = self.regularization[stage_idx]
+        halo = regularization.tile_halo
+        b, d, h, w = depth_hypotheses.shape
+        core, chunk = self.tile_size(stage_idx, features_stage, d)
+        if core >= h and core >= w:
+            return regularization(self.aggregation[stage_idx](features_stage, src_projs, depth_hypotheses, chunk=chunk))
+
+        cost_reg = depth_hypotheses.start.new_empty(b, 1, d, h, w)
+        for y0 in range(0, h, core):
+            for x0 in range(0, w, core):
+                y1, x1 = min(y0 + core, h), min(x0 + core, w)
+                # tile with halo
+                ty0, tx0 = max(y0 - halo, 0), max(x0 - halo, 0)
+                ty1, tx1 = min(y1 + halo, h), min(x1 + halo, w)
+                cost_volume = self.aggregation[stage_idx](features_stage, src_projs,
+                                                          depth_hypotheses.crop(ty0, tx0, ty1 - ty0, tx1 - tx0),
+                                                          roi=(ty0, tx0, ty1 - ty0, tx1 - tx0), chunk=chunk)
+                tile_reg = regularization(cost_volume)
+                cost_reg[:, :, :, y0: y1, x0: x1] = tile_reg[:, :, :, y0 - ty0: y1 - ty0, x0 - tx0: x1 - tx0]
+                del cost_volume, tile_reg
+        return cost_reg
+
+    def forward(self, data, icc=False, scc=False, epoch=0, features=None, proj_bundle=None):
+        """
+        :param features: features of the pass images, extracted when not given
+        :param proj_bundle: ProjectionBundle of the pass views, built when not given
+        """
         outputs = {} 
         imgs = data["imgs"]               
         proj_matrices = data["proj_matrices"] 
@@ -315,17 +499,22 @@ class CasMVSNet(nn.Module):
             imgs = data["imgs_scc"]
             proj_matrices = data["proj_matrices_scc"]
 
+        if proj_bundle is None:
+            proj_bundle = ProjectionBundle(proj_matrices)
+
         init_depth_hypotheses  = data["init_depth_hypotheses"]
         interval_base = (init_depth_hypotheses[0, -1] - init_depth_hypotheses[0, 0]) / init_depth_hypotheses.size(1)
         
-        features = []
-        for nview_idx in range(imgs.size(1)):  
-            img = imgs[:, nview_idx]
-            features.append(self.feature(img))
+        if features is None:
+            with self.timed("features"):
+                if self.feature_cache is not None and not self.training and not (icc or scc) and "scene" in data:
+                    features = self.feature_cache.features(self.feature, imgs, data["scene"], data["view_ids"])
+                else:
+                    features = self.extract_features(imgs)
         
         for stage_idx in range(self.num_stage):
             features_stage = [feat["stage{}".format(stage_idx + 1)] for feat in features]
-            proj_matrices_stage = proj_matrices["stage{}".format(stage_idx + 1)]
+            src_projs = proj_bundle.src_projs["stage{}".format(stage_idx + 1)]
             stage_shape = features_stage[0].shape[2:]
 
             if stage_idx == 0:
@@ -333,11 +522,15 @@ class CasMVSNet(nn.Module):
             else:
                 last_outs = outputs["stage{}".format(stage_idx)]
 
-            depth_hypotheses = self.sampler[stage_idx](last_outs, stage_shape, interval_base)
-            cost_volume = self.aggregation[stage_idx](features_stage, proj_matrices_stage, depth_hypotheses)
-            cost_reg = self.regularization[stage_idx](cost_volume)
-            # depth
-            outputs_stage = self.depth_head[stage_idx](cost_reg=cost_reg, depth_hypotheses=depth_hypotheses)
+            with self.timed("stage{}".format(stage_idx + 1)):
+                depth_hypotheses = self.sampler[stage_idx](last_outs, stage_shape, interval_base)
+                if self.args.tile_mb > 0 and not self.training:
+                    cost_reg = self.tiled_cost_reg(stage_idx, features_stage, src_projs, depth_hypotheses)
+                else:
+                    cost_volume = self.aggregation[stage_idx](features_stage, src_projs, depth_hypotheses)
+                    cost_reg = self.regularization[stage_idx](cost_volume)
+                # depth
+                outputs_stage = self.depth_head[stage_idx](cost_reg=cost_reg, depth_hypotheses=depth_hypotheses)
             outputs["stage{}".format(stage_idx + 1)] = outputs_stage
             outputs.update(outputs_stage)
 
@@ -351,12 +544,20 @@ class DOMVSNet(nn.Module):
     def forward(self, data, mode, epoch=0):
         assert mode in ["train", "val", "test"], "mode wrong!"
         outputs = {}
-        output1 = self.model(data)
+        if mode == "test":
+            output1 = self.model(data)
+        else:
+            features = self.model.extract_features(data["imgs"])
+            # the icc pass sees the same views as the clean one
+            proj_bundle = ProjectionBundle(data["proj_matrices"])
+            output1 = self.model(data, features=features, proj_bundle=proj_bundle)
         outputs["output1"] = output1
         if mode in ["train", "val"]:
-            output2 = self.model(data, icc=True, epoch=epoch)
-            output3 = self.model(data, scc=True)
+            output2 = self.model(data, icc=True, epoch=epoch, proj_bundle=proj_bundle)
+            output3 = self.model(data, scc=True, features=self.model.scc_features(data, features))
             outputs["output2"] = output2     
             outputs["output3"] = output3
+            # the photometric loss warps with the clean pass projections
+            outputs["proj_bundle"] = proj_bundle
         outputs.update(output1)
         return outputs
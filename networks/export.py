@@ -0,0 +1,139 @@
+import json
+import torch
+import torch.nn as nn
+from .module import ProjectionBundle
+
+
+class _StageProjections(object):
+    """ the src_projs of a ProjectionBundle given as graph inputs """
+    def __init__(self, src_projs):
+        self.src_projs = {"stage{}".format(stage_idx + 1): projs for stage_idx, projs in enumerate(src_projs)}
+
+
+class CasMVSNetTestGraph(nn.Module):
+    """Tensor in / tensor out test path of CasMVSNet, for graph capture.
+
+    The projection matrices are inverted outside of the graph, it takes the src_proj @ inverse(ref_proj) of every
+    stage and returns the depth and the photometric confidence of every stage. The captured graph is specialized
+    to the batch size, the image size and the number of views of the example batch.
+    """
+    def __init__(self, model):
+        super(CasMVSNetTestGraph, self).__init__()
+        self.model = model
+
+    def forward(self, imgs, init_depth_hypotheses, *src_projs):
+        data = {"imgs": imgs, "proj_matrices": None, "init_depth_hypotheses": init_depth_hypotheses}
+        outputs = self.model(data, proj_bundle=_StageProjections(src_projs))
+        confidences = [outputs["stage{}".format(stage_idx + 1)]["photometric_confidence"]
+                       for stage_idx in range(self.model.num_stage)]
+        return tuple([outputs["depth"]] + confidences)
+
+
+def test_graph_inputs(data, num_stage):
+    bundle = ProjectionBundle(data["proj_matrices"])
+    src_projs = [bundle.src_projs["stage{}".format(stage_idx + 1)] for stage_idx in range(num_stage)]
+    return tuple([data["imgs"], data["init_depth_hypotheses"]] + src_projs)
+
+
+def test_graph_outputs(outputs):
+    """ graph outputs -> the test outputs of DOMVSNet that Model.test reads """
+    depth, confidences = outputs[0], outputs[1:]
+    test_outputs = {"depth": depth, "photometric_confidence": confidences[-1]}
+    for stage_idx, confidence in enumerate(confidences):
+        test_outputs["stage{}".format(stage_idx + 1)] = {"photometric_confidence": confidence}
+    return test_outputs
+
+
+def input_shapes_filename(path):
+    """ sidecar of an artifact with the input shapes it was captured with """
+    return path + ".json"
+
+
+def export_test_graph(model, data, path, fmt="torchscript", depth_tol=1e-2, confidence_tol=1e-3):
+    """
+    capture the test path of an eval mode CasMVSNet on the example batch data, save it to path and check that the
+    saved artifact reproduces the eager outputs of data, the input shapes are written next to it
+    :param fmt: torchscript (frozen trace), torch_export (torch.export program) or onnx (opset 16, for onnxruntime)
+    :param depth_tol: largest accepted depth difference, in the units of the depth hypotheses
+    :param confidence_tol: largest accepted photometric confidence difference
+    :return: max absolute difference of the depth and of the confidences
+    """
+    graph = CasMVSNetTestGraph(model).eval()
+    inputs = test_graph_inputs(data, model.num_stage)
+    input_names = ["imgs", "init_depth_hypotheses"] + ["src_projs_stage{}".format(i + 1) for i in range(model.num_stage)]
+    output_names = ["depth"] + ["confidence_stage{}".format(i + 1) for i in range(model.num_stage)]
+    with torch.no_grad():
+        if fmt == "torchscript":
+            traced = torch.jit.trace(graph, inputs, check_trace=False)
+            torch.jit.save(torch.jit.freeze(traced), path)
+        elif fmt == "torch_export":
+            torch.export.save(torch.export.export(graph, inputs), path)
+        elif fmt == "onnx":
+            torch.onnx.export(graph, inputs, path, opset_version=16, input_names=input_names, output_names=output_names)
+        else:
+            raise NotImplementedError("invalid export format {}".format(fmt))
+        with open(input_shapes_filename(path), "w") as f:
+            json.dump({name: list(tensor.shape) for name, tensor in zip(input_names, inputs)}, f)
+
+        # parity of the reloaded artifact and the eager network
+        eager = test_graph_outputs(graph(*inputs))
+        exported = ExportedTestGraph(path, data["imgs"].device, model.num_stage)(data)
+    depth_diff = (exported["depth"] - eager["depth"]).abs().max().item()
+    confidence_diff = max((exported["stage{}".format(i + 1)]["photometric_confidence"] -
+                           eager["stage{}".format(i + 1)]["photometric_confidence"]).abs().max().item()
+                          for i in range(model.num_stage))
+    if depth_diff > depth_tol or confidence_diff > confidence_tol:
+        raise RuntimeError("exported {} test path differs from the network, max depth difference {} (tolerance {}), "
+                           "max confidence difference {} (tolerance {})".format(
+                               fmt, depth_diff, depth_tol, confidence_diff, confidence_tol))
+    return depth_diff, confidence_diff
+
+
+class ExportedTestGraph(object):
+    """Test path loaded from an artifact of export_test_graph, called with a test batch like DOMVSNet in test mode.
+
+    Loading needs torch only (and onnxruntime for .onnx artifacts), neither the network code nor the losses.
+    Batches are checked against the captured input shapes: another batch size is padded and split into captured
+    size batches, another image size or number of views raises a ValueError.
+    """
+    def __init__(self, path, device, num_stage):
+        self.path = path
+        self.device = device
+        self.num_stage = num_stage
+        with open(input_shapes_filename(path)) as f:
+            self.input_shapes = json.load(f)
+        self.session = None
+        if path.endswith(".onnx"):
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        elif path.endswith(".pt2"):
+            self.graph = torch.export.load(path).module().to(device)
+        else:
+            self.graph = torch.jit.load(path, map_location=device)
+
+    def check_inputs(self, inputs):
+        for (name, shape), tensor in zip(self.input_shapes.items(), inputs):
+            if list(tensor.shape[1:]) != shape[1:]:
+                raise ValueError("{} of shape {} does not match the shape {} that {} was captured with, export the "
+                                 "test path again for this input size".format(name, list(tensor.shape), shape,
+                                                                              self.path))
+
+    def run(self, inputs):
+        if self.session is not None:
+            feeds = {arg.name: tensor.cpu().numpy() for arg, tensor in zip(self.session.get_inputs(), inputs)}
+            return [torch.from_numpy(output).to(self.device) for output in self.session.run(None, feeds)]
+        return self.graph(*inputs)
+
+    def __call__(self, data, mode="test"):
+        inputs = test_graph_inputs(data, self.num_stage)
+        self.check_inputs(inputs)
+        batch_size = inputs[0].size(0)
+        graph_batch_size = self.input_shapes["imgs"][0]
+        if batch_size == graph_batch_size:
+            return test_graph_outputs(self.run(inputs))
+
+        # repeat the last sample up to a multiple of the captured batch size, the padded outputs are dropped
+        num_pad = -batch_size % graph_batch_size
+        inputs = [torch.cat([tensor, tensor[-1:].expand(num_pad, *tensor.shape[1:])]) for tensor in inputs]
+        outputs = [self.run(chunk) for chunk in zip(*[tensor.split(graph_batch_size) for tensor in inputs])]
+        return test_graph_outputs([torch.cat(output)[:batch_size] for output in zip(*outputs)])
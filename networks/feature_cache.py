@@ -0,0 +1,77 @@
+import torch
+from collections import OrderedDict
+
+
+class FeatureCache(object):
+    """LRU cache of the per-view FPN outputs used at test time.
+
+    Entries are keyed by (scene, view_id, image size) and the total size is bounded by max_mb. Features can be
+    stored in fp16 to fit twice as many views, they are cast back to the input dtype when read. The cache is
+    emptied whenever a batch from another scene arrives.
+    """
+    def __init__(self, max_mb, fp16=False):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.fp16 = fp16
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.scene = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+        self.scene = None
+
+    def set_scene(self, scenes):
+        if any(scene != self.scene for scene in scenes):
+            self.clear()
+            self.scene = scenes[-1]
+
+    def get(self, key):
+        feat = self.entries.get(key)
+        if feat is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return feat
+
+    def put(self, key, feat):
+        feat = {stage: f.half() if self.fp16 else f.clone() for stage, f in feat.items()}
+        size = sum(f.numel() * f.element_size() for f in feat.values())
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= sum(f.numel() * f.element_size() for f in self.entries.pop(key).values())
+        while self.num_bytes + size > self.max_bytes:
+            _, old_feat = self.entries.popitem(last=False)
+            self.num_bytes -= sum(f.numel() * f.element_size() for f in old_feat.values())
+        self.entries[key] = feat
+        self.num_bytes += size
+
+    def features(self, feature_net, imgs, scenes, view_ids):
+        """
+        :param imgs: (b, nview, c, h, w)
+        :param scenes: b scene names
+        :param view_ids: nview tensors of shape (b,)
+        :return: [ref_feat, src_feat1, ...] in the format of FPNFeature
+        """
+        self.set_scene(scenes)
+        features = []
+        for view_idx in range(imgs.size(1)):
+            img = imgs[:, view_idx]
+            keys = [(scene, int(vid), tuple(img.shape[-2:])) for scene, vid in zip(scenes, view_ids[view_idx])]
+            cached = [self.get(key) for key in keys]
+            if all(feat is not None for feat in cached):
+                feat = {stage: torch.stack([c[stage] for c in cached]).to(img.dtype) for stage in cached[0]}
+            else:
+                feat = feature_net(img)
+                for batch_idx, key in enumerate(keys):
+                    self.put(key, {stage: f[batch_idx] for stage, f in feat.items()})
+            features.append(feat)
+        return features
+
+    def stats(self):
+        return "hits:{} misses:{} entries:{} size:{:.1f}MB".format(self.hits, self.misses, len(self.entries),
+                                                                   self.num_bytes / 1024 / 1024)
@@ -5,6 +5,7 @@ import sys
 import numpy as np
 
 sys.path.append("..")
+from tools import float32_region
 
 
 def init_bn(module):
@@ -205,42 +206,306 @@ class Deconv3d(nn.Module):
             init_bn(self.bn)
 
 
-def homo_warping(src_fea, src_proj, ref_proj, depth_values):
-    # src_fea: [B, C, H, W]
-    # src_proj: [B, 4, 4]
-    # ref_proj: [B, 4, 4]
-    # depth_values: [B, Ndepth] o [B, Ndepth, H, W]
-    # out: [B, C, Ndepth, H, W]
-    batch, channels = src_fea.shape[0], src_fea.shape[1]
-    num_depth = depth_values.shape[1]
-    height, width = src_fea.shape[2], src_fea.shape[3]
+class ViewGroupedBatchNorm2d(nn.BatchNorm2d):
+    """BatchNorm2d for a batch of num_views views folded as (b * num_views, c, h, w), batch major.
 
+    In train mode every view is normalized with its own statistics and the running statistics are updated view
+    after view, exactly as when the views go through the network one by one. Eval mode is a plain BatchNorm2d.
+    """
+    num_views = 1
+
+    def forward(self, x):
+        if not self.training or self.num_views == 1:
+            return super(ViewGroupedBatchNorm2d, self).forward(x)
+
+        n, c, h, w = x.shape
+        v = self.num_views
+        # (b, v * c, h, w) is a view of the folded batch, each channel of it belongs to one view
+        x_views = x.view(n // v, v * c, h, w)
+        weight = self.weight.repeat(v) if self.affine else None
+        bias = self.bias.repeat(v) if self.affine else None
+        y = F.batch_norm(x_views, None, None, weight, bias, True, 0.0, self.eps)
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                var, mean = torch.var_mean(x_views, dim=(0, 2, 3), unbiased=True)
+                for mean_v, var_v in zip(mean.view(v, c), var.view(v, c)):
+                    self.num_batches_tracked += 1
+                    momentum = self.momentum if self.momentum is not None else 1.0 / float(self.num_batches_tracked)
+                    self.running_mean.mul_(1 - momentum).add_(mean_v, alpha=momentum)
+                    self.running_var.mul_(1 - momentum).add_(var_v, alpha=momentum)
+
+        return y.view(n, c, h, w)
+
+
+def convert_view_bn(module):
+    """ replace the BatchNorm2d layers of module by ViewGroupedBatchNorm2d, the state dict is unchanged """
+    for name, child in module.named_children():
+        if type(child) is nn.BatchNorm2d:
+            bn = ViewGroupedBatchNorm2d(child.num_features, child.eps, child.momentum, child.affine,
+                                        child.track_running_stats).to(child.weight.device)
+            bn.load_state_dict(child.state_dict())
+            setattr(module, name, bn)
+        else:
+            convert_view_bn(child)
+    return module
+
+
+def set_bn_views(module, num_views):
+    for m in module.modules():
+        if isinstance(m, ViewGroupedBatchNorm2d):
+            m.num_views = num_views
+
+
+class FusedConv(nn.Module):
+    """Eval mode Conv2d/Deconv2d/Conv3d/Deconv3d wrapper whose batch normalization is folded in the convolution.
+
+    Only the batch normalization is folded, the relu still runs in place after the convolution in eager mode.
+    crop keeps the output of stride 2 Deconv2d at twice the input size.
+    """
+    def __init__(self, conv, relu, crop=False):
+        super(FusedConv, self).__init__()
+        self.conv = conv
+        self.relu = relu
+        self.crop = crop
+
+    def forward(self, x):
+        y = self.conv(x)
+        if self.crop:
+            h, w = list(x.size())[2:]
+            y = y[:, :, :2 * h, :2 * w]
+        if self.relu:
+            y = F.relu(y, inplace=True)
+        return y
+
+
+def fold_bn(conv, bn):
+    """ fold the running statistics and affine parameters of bn in the weights and bias of conv """
+    transposed = isinstance(conv, nn.modules.conv._ConvTransposeNd)
+    assert not transposed or conv.groups == 1, "grouped transposed convolutions are not supported"
     with torch.no_grad():
-        proj = torch.matmul(src_proj, torch.inverse(ref_proj))
-        rot = proj[:, :3, :3]  # [B,3,3]
-        trans = proj[:, :3, 3:4]  # [B,3,1]
-
-        y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=src_fea.device),
-                               torch.arange(0, width, dtype=torch.float32, device=src_fea.device)])
-        y, x = y.contiguous(), x.contiguous()
-        y, x = y.view(height * width), x.view(height * width)
-        xyz = torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
-        xyz = torch.unsqueeze(xyz, 0).repeat(batch, 1, 1)  # [B, 3, H*W]
-        rot_xyz = torch.matmul(rot, xyz)  # [B, 3, H*W]
-        rot_depth_xyz = rot_xyz.unsqueeze(2).repeat(1, 1, num_depth, 1) * depth_values.view(batch, 1, num_depth,
-                                                                                            -1)  # [B, 3, Ndepth, H*W]
-        proj_xyz = rot_depth_xyz + trans.view(batch, 3, 1, 1)  # [B, 3, Ndepth, H*W]
-        proj_xyz[:, 2:3][proj_xyz[:, 2:3] == 0] += 0.00001  # NAN BUG, not on dtu, but on blendedmvs
-
-        proj_xy = proj_xyz[:, :2, :, :] / proj_xyz[:, 2:3, :, :]  # [B, 2, Ndepth, H*W]
-        proj_x_normalized = proj_xy[:, 0, :, :] / ((width - 1) / 2) - 1
-        proj_y_normalized = proj_xy[:, 1, :, :] / ((height - 1) / 2) - 1
-        proj_xy = torch.stack((proj_x_normalized, proj_y_normalized), dim=3)  # [B, Ndepth, H*W, 2]
-        grid = proj_xy
-
-    warped_src_fea = F.grid_sample(src_fea, grid.view(batch, num_depth * height, width, 2), mode='bilinear',
-                                   padding_mode='zeros').type(torch.float32)
-    warped_src_fea = warped_src_fea.view(batch, channels, num_depth, height, width)
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.affine:
+            scale = scale * bn.weight
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            shift = shift + bn.bias
+        # output channels are the first dim of convolution weights and the second of transposed ones
+        shape = [1, -1] if transposed else [-1, 1]
+        conv.weight.mul_(scale.view(*shape, *([1] * (conv.weight.dim() - 2))))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(scale)
+        conv.bias = nn.Parameter(bias * scale + shift, requires_grad=False)
+    return conv
+
+
+def fuse_conv_bn(module):
+    """ replace the Conv2d/Deconv2d/Conv3d/Deconv3d wrappers of an eval mode module by FusedConv """
+    for name, child in module.named_children():
+        if isinstance(child, (Conv2d, Deconv2d, Conv3d, Deconv3d)):
+            assert not child.training, "batchnorm can only be folded in eval mode"
+            conv = fold_bn(child.conv, child.bn) if child.bn is not None else child.conv
+            crop = isinstance(child, Deconv2d) and child.stride == 2
+            setattr(module, name, FusedConv(conv, child.relu, crop))
+        else:
+            fuse_conv_bn(child)
+    return module
+
+
+class QuantizedConv(nn.Module):
+    """FusedConv run in int8, its float input is quantized and its output dequantized.
+
+    The int8 region is the convolution (and its relu) only, the attention blocks, additions and upsampling around
+    it stay in float. Transposed convolutions are quantized with per-tensor weights.
+    """
+    def __init__(self, fused, backend="fbgemm"):
+        super(QuantizedConv, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.conv = fused.conv
+        self.relu = nn.ReLU() if fused.relu else None
+        self.dequant = torch.quantization.DeQuantStub()
+        self.crop = fused.crop
+
+        qconfig = torch.quantization.get_default_qconfig(backend)
+        if isinstance(self.conv, nn.modules.conv._ConvTransposeNd):
+            qconfig = torch.quantization.QConfig(activation=qconfig.activation,
+                                                 weight=torch.quantization.default_weight_observer)
+        elif self.relu is not None:
+            torch.quantization.fuse_modules(self, [["conv", "relu"]], inplace=True)
+        self.qconfig = qconfig
+
+    def forward(self, x):
+        h, w = list(x.size())[-2:]
+        y = self.conv(self.quant(x))
+        if self.relu is not None:
+            y = self.relu(y)
+        y = self.dequant(y)
+        if self.crop:
+            y = y[:, :, :2 * h, :2 * w]
+        return y
+
+
+def prepare_int8(module, backend="fbgemm"):
+    """
+    fold the batchnorm of an eval mode module and replace its conv wrappers by QuantizedConv with observers,
+    calibrate by running it on float inputs and call convert_int8 afterwards
+    """
+    assert backend in torch.backends.quantized.supported_engines, \
+        "quantized backend {} is not supported here, use one of {}".format(backend, torch.backends.quantized.supported_engines)
+    torch.backends.quantized.engine = backend
+    fuse_conv_bn(module)
+    _replace_fused(module, backend)
+    torch.quantization.prepare(module, inplace=True)
+    return module
+
+
+def _replace_fused(module, backend):
+    for name, child in module.named_children():
+        if isinstance(child, FusedConv):
+            setattr(module, name, QuantizedConv(child, backend))
+        else:
+            _replace_fused(child, backend)
+
+
+def convert_int8(module):
+    """ swap the observed convolutions of a prepare_int8 module for their int8 kernels, cpu only """
+    return torch.quantization.convert(module, inplace=True)
+
+
+class DepthHypotheses(object):
+    """Depth hypotheses start + k * interval, k = 0, ..., num - 1, of a (h, w) reference view.
+
+    Kept compact instead of a dense (b, num, h, w) tensor: start is (b,) when every pixel shares the same depths and
+    (b, h, w) when they are per pixel, interval is (b,). Consumers expand them lazily or broadcast.
+    """
+    def __init__(self, start, interval, num, shape):
+        self.start = start
+        self.interval = interval
+        self.num = num
+        self.height, self.width = int(shape[0]), int(shape[1])
+
+    @property
+    def per_pixel(self):
+        return self.start.dim() == 3
+
+    @property
+    def shape(self):
+        return self.start.size(0), self.num, self.height, self.width
+
+    def steps(self):
+        return torch.arange(0, self.num, device=self.start.device, dtype=self.start.dtype)
+
+    def values(self):
+        """ depths broadcastable to (b, d, h, w): (b, d, 1, 1) per image, (b, d, h, w) per pixel """
+        if self.per_pixel:
+            return self.start.unsqueeze(1) + self.steps().view(1, -1, 1, 1) * self.interval.view(-1, 1, 1, 1)
+        values = self.start.unsqueeze(1) + self.steps().view(1, -1) * self.interval.unsqueeze(1)
+        return values.view(-1, self.num, 1, 1)
+
+    def dense(self):
+        """ (b, d, h, w) """
+        return self.values().expand(*self.shape)
+
+    def crop(self, y0, x0, height, width):
+        """ hypotheses of the (y0, x0, height, width) window """
+        start = self.start[:, y0: y0 + height, x0: x0 + width] if self.per_pixel else self.start
+        return DepthHypotheses(start, self.interval, self.num, (height, width))
+
+    def regression(self, index):
+        """ depth (b, h, w) at the fractional hypothesis index (b, h, w) """
+        start = self.start if self.per_pixel else self.start.view(-1, 1, 1)
+        return start + index * self.interval.view(-1, 1, 1)
+
+
+class ProjectionBundle(object):
+    """Projection matrices of a batch in the form the warping needs, computed once on their device.
+
+    For every stage of proj_matrices ({"stage1": (b, nview, 2, 4, 4), ...}, extrinsics in [:, :, 0] and intrinsics
+    in [:, :, 1, :3, :3]) it holds the K[R|t] of every view, the inverse of the reference one and the
+    src_proj @ inverse(ref_proj) transforms of the source views. All the passes over the same views share a bundle.
+    """
+    def __init__(self, proj_matrices):
+        self.projs = {}
+        self.ref_invs = {}
+        self.src_projs = {}
+        with torch.no_grad(), float32_region():
+            for stage, stage_matrices in proj_matrices.items():
+                projs = stage_matrices[:, :, 0].clone()
+                projs[:, :, :3, :4] = torch.matmul(stage_matrices[:, :, 1, :3, :3], stage_matrices[:, :, 0, :3, :4])
+                ref_inv = torch.inverse(projs[:, 0])
+                self.projs[stage] = projs  # (b, nview, 4, 4)
+                self.ref_invs[stage] = ref_inv  # (b, 4, 4)
+                self.src_projs[stage] = torch.matmul(projs[:, 1:], ref_inv.unsqueeze(1))  # (b, nview-1, 4, 4)
+
+
+def pixel_grid(height, width, device, y0=0, x0=0):
+    # out: [3, H*W] homogeneous pixel coordinates of the window starting at (y0, x0)
+    y, x = torch.meshgrid([torch.arange(y0, y0 + height, dtype=torch.float32, device=device),
+                           torch.arange(x0, x0 + width, dtype=torch.float32, device=device)])
+    y, x = y.contiguous(), x.contiguous()
+    y, x = y.view(height * width), x.view(height * width)
+    return torch.stack((x, y, torch.ones_like(x)))
+
+
+def plane_homographies(proj, depth_values):
+    # proj: [B, V, 4, 4] src_proj @ inverse(ref_proj)
+    # depth_values: [B, Ndepth] depths of fronto-parallel planes of the reference view
+    # out: [B, V, Ndepth, 3, 3] homographies d * R + t @ [0, 0, 1] from reference to source pixels
+    rot = proj[:, :, :3, :3].unsqueeze(2)  # [B, V, 1, 3, 3]
+    trans = F.pad(proj[:, :, :3, 3:4], (2, 0)).unsqueeze(2)  # [B, V, 1, 3, 3], t in the last column
+    return rot * depth_values.view(depth_values.size(0), 1, -1, 1, 1) + trans
+
+
+def homo_warping_views(src_feas, proj, depth_hypotheses, xyz=None, roi=None):
+    # src_feas: [B, V, C, H, W]
+    # proj: [B, V, 4, 4] src_proj @ inverse(ref_proj)
+    # depth_hypotheses: DepthHypotheses of the reference window
+    # xyz: [3, h*w] pixel grid of the reference window, built when not given
+    # roi: (y0, x0, h, w) reference window to warp to, the whole image when not given
+    # out: [B, V, C, Ndepth, h, w]
+    batch, num_views, channels, src_height, src_width = src_feas.shape
+    num_depth = depth_hypotheses.num
+    y0, x0, height, width = roi if roi is not None else (0, 0, src_height, src_width)
+    # the geometry and the sampling run in float32 under autocast, the warped volume has the dtype of the features
+    dtype = src_feas.dtype
+
+    with torch.no_grad(), float32_region():
+        if xyz is None:
+            xyz = pixel_grid(height, width, src_feas.device, y0, x0)
+        if depth_hypotheses.per_pixel:
+            rot = proj[:, :, :3, :3]  # [B,V,3,3]
+            trans = proj[:, :, :3, 3:4]  # [B,V,3,1]
+
+            rot_xyz = torch.matmul(rot, xyz)  # [B, V, 3, h*w]
+            depth_values = depth_hypotheses.values().reshape(batch, 1, 1, num_depth, -1)
+            rot_depth_xyz = rot_xyz.unsqueeze(3) * depth_values  # [B, V, 3, Ndepth, h*w]
+            proj_xyz = rot_depth_xyz + trans.view(batch, num_views, 3, 1, 1)  # [B, V, 3, Ndepth, h*w]
+            proj_xyz = proj_xyz.transpose(2, 3)  # [B, V, Ndepth, 3, h*w]
+            # NAN BUG, not on dtu, but on blendedmvs. out of place so that the warping can be exported
+            proj_z = proj_xyz[:, :, :, 2:3]
+            proj_z = torch.where(proj_z == 0, proj_z + 0.00001, proj_z)
+
+            proj_xy = proj_xyz[:, :, :, :2] / proj_z  # [B, V, Ndepth, 2, h*w]
+            proj_x_normalized = proj_xy[:, :, :, 0] / ((src_width - 1) / 2) - 1
+            proj_y_normalized = proj_xy[:, :, :, 1] / ((src_height - 1) / 2) - 1
+            grid = torch.stack((proj_x_normalized, proj_y_normalized), dim=4)  # [B, V, Ndepth, h*w, 2]
+        else:
+            # fronto-parallel sweep, one homography per view and depth maps the pixel grid directly
+            homographies = plane_homographies(proj, depth_hypotheses.values().view(batch, num_depth))
+            rows_z = homographies[:, :, :, 2:3]  # [B, V, Ndepth, 1, 3]
+            # the normalization of grid_sample is folded in the x / y rows:
+            # 2 * x / z / (w - 1) - 1 = (2 / (w - 1) * x - z) / z
+            scale = homographies.new_tensor([2.0 / (src_width - 1), 2.0 / (src_height - 1)]).view(2, 1)
+            rows_xy = homographies[:, :, :, :2] * scale - rows_z  # [B, V, Ndepth, 2, 3]
+            # the rows map the pixel grid straight to the sampling grid layout, no [B, V, Ndepth, 3, h*w] points
+            proj_z = torch.matmul(xyz.t(), rows_z.transpose(3, 4))  # [B, V, Ndepth, h*w, 1]
+            proj_z = torch.where(proj_z == 0, proj_z + 0.00001, proj_z)  # NAN BUG, not on dtu, but on blendedmvs
+            grid = torch.matmul(xyz.t(), rows_xy.transpose(3, 4)).div_(proj_z)  # [B, V, Ndepth, h*w, 2]
+
+    with float32_region():
+        warped_src_fea = F.grid_sample(src_feas.reshape(batch * num_views, channels, src_height, src_width).float(),
+                                       grid.view(batch * num_views, num_depth * height, width, 2), mode='bilinear',
+                                       padding_mode='zeros').to(dtype)
+    warped_src_fea = warped_src_fea.view(batch, num_views, channels, num_depth, height, width)
 
     return warped_src_fea
 
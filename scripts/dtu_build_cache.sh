@@ -0,0 +1,7 @@
+#!/usr/bin/env bash
+source /home/vgg/anaconda3/etc/profile.d/conda.sh
+
+conda activate mvs
+python build_cache.py \
+        --datapath /media/data2/datasets/DTU_Dataset/dtu_training \
+        --listfile datasets/lists/dtu/train.txt datasets/lists/dtu/val.txt
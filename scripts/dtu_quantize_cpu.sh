@@ -0,0 +1,12 @@
+#!/usr/bin/env bash
+source /home/vgg/anaconda3/etc/profile.d/conda.sh
+
+conda activate kunpython37
+python main.py \
+        --val \
+        --no_cuda \
+        --numa_node 0 \
+        --quantize /media/data3/code/wqj/DOMVS/pretrained_model/model_int8.ckpt \
+        --calib_datapath /media/data3/code/wqj/dtu_test/ \
+        --calib_list /media/data3/code/wqj/CL-MVSNet-master/datasets/lists/dtu/test.txt \
+        --resume /media/data3/code/wqj/DOMVS/pretrained_model/model.ckpt
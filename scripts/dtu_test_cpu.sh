@@ -0,0 +1,15 @@
+#!/usr/bin/env bash
+source /home/vgg/anaconda3/etc/profile.d/conda.sh
+
+conda activate kunpython37
+python main.py \
+        --test \
+        --no_cuda \
+        --numa_node 0 \
+        --num_interop_threads 1 \
+        --stage_latency \
+        --dataset_name "general_eval" \
+        --datapath  /media/data3/code/wqj/dtu_test/ \
+        --img_size 1184 1600 \
+        --resume /media/data3/code/wqj/DOMVS/pretrained_model/model.ckpt \
+        --testlist /media/data3/code/wqj/CL-MVSNet-master/datasets/lists/dtu/test.txt
@@ -6,6 +6,10 @@ import torchvision.utils as vutils
 import torch.distributed as dist
 from torch.optim.lr_scheduler import LambdaLR
 import torch.nn as nn
+import torch.nn.functional as F
+import functools
+import contextlib
+import time
 
 class DictAverageMeter(object):
     def __init__(self):
@@ -148,14 +152,108 @@ def reduce_scalar_outputs(scalar_outputs):
     return reduced_scalars
 
 
-@make_recursive_func
+def todevice(vars, device):
+    @make_recursive_func
+    def to(vars):
+        if isinstance(vars, torch.Tensor):
+            return vars.to(device)
+        elif isinstance(vars, str):
+            return vars
+        else:
+            raise NotImplementedError("invalid input type {} for todevice".format(type(vars)))
+
+    return to(vars)
+
+
 def tocuda(vars):
-    if isinstance(vars, torch.Tensor):
-        return vars.to(torch.device("cuda"))
-    elif isinstance(vars, str):
-        return vars
-    else:
-        raise NotImplementedError("invalid input type {} for tensor2numpy".format(type(vars)))
+    return todevice(vars, torch.device("cuda"))
+
+
+def autocast(device, amp):
+    """ autocast context of an --amp mode, fp16 is only used on cuda and falls back to bf16 on the cpu """
+    if amp == "none":
+        return contextlib.nullcontext()
+    dtype = torch.float16 if amp == "fp16" and device.type == "cuda" else torch.bfloat16
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+@contextlib.contextmanager
+def float32_region():
+    """ turn autocast off, for the parts that must stay in float32 """
+    with torch.autocast(device_type="cpu", enabled=False):
+        if torch.cuda.is_available():
+            with torch.autocast(device_type="cuda", enabled=False):
+                yield
+        else:
+            yield
+
+
+def parse_cpulist(cpulist):
+    """ "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11] """
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def setup_cpu_threads(args):
+    """
+    pin the process to the cpus of args.numa_node and set the intra-op / inter-op thread pools, must run before
+    any parallel work. Memory is first touched by the pinned threads so it is allocated on the same node.
+    """
+    if args.numa_node >= 0:
+        with open("/sys/devices/system/node/node{}/cpulist".format(args.numa_node)) as f:
+            cpus = parse_cpulist(f.read())
+        os.sched_setaffinity(0, cpus)
+        print("pinned to numa node {}, cpus {}".format(args.numa_node, cpus))
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    elif args.numa_node >= 0:
+        torch.set_num_threads(len(os.sched_getaffinity(0)))
+    if args.num_interop_threads > 0:
+        torch.set_num_interop_threads(args.num_interop_threads)
+
+
+def free_memory_mb(device):
+    """ memory available to new tensors of device in MB, the blocks cached by the cuda allocator included """
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        return free / 1024 / 1024
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+class StageTimer(object):
+    """Wall time of the named parts of the test path, cuda is synchronized so that device work is counted."""
+    def __init__(self, device):
+        self.device = device
+        self.totals = {}
+        self.counts = {}
+
+    def sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def time(self, name):
+        self.sync()
+        start = time.perf_counter()
+        yield
+        self.sync()
+        self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def clear(self):
+        self.totals.clear()
+        self.counts.clear()
+
+    def report(self):
+        """ mean latency of every part in ms """
+        return {name: round(1000 * total / self.counts[name], 2) for name, total in self.totals.items()}
 
 
 # a wrapper to compute metrics for each image individually
@@ -315,55 +413,65 @@ def init_distributed_mode(args):
     setup_for_distributed(args.rank == 0)
     
 def smooth_item_l0_5(x,beta):
-    mask = x<beta
-    if not mask.sum()== 0:
-        x[mask] = 32768*torch.square(x[mask])
-    if not (~mask).sum()== 0:
-        x[~mask] = torch.sqrt(x[~mask])
-    return x
-
-def smooth_l0_5(pred, gt, beta=0.00097656):
+    # 32768 * x^2 below beta and sqrt(x) above it, selected with where() so there is no host sync nor data dependent
+    # indexing. sqrt only sees values >= beta so the gradient of the unselected branch stays finite
+    mask = x < beta
+    return torch.where(mask, 32768 * torch.square(x), torch.sqrt(torch.where(mask, torch.ones_like(x), x)))
+
+def _smooth_l0_5(error, beta, dim=None):
+    if dim is None:
+        return torch.mean(smooth_item_l0_5(torch.abs(error), beta))
+    return torch.mean(smooth_item_l0_5(torch.abs(error), beta), dim=dim)
+
+_smooth_l0_5_kernel = _smooth_l0_5
+
+def compile_smooth_l0_5():
+    """ fuse the penalty with torch.compile, kept eager on torch versions without it """
+    global _smooth_l0_5_kernel
+    if hasattr(torch, "compile"):
+        _smooth_l0_5_kernel = torch.compile(_smooth_l0_5, dynamic=True)
+
+def smooth_l0_5(pred, gt, beta=0.00097656, dim=None):
+    # dim: dims to average over, all of them when not given
     assert pred.shape == gt.shape, "the shapes of pred and gt are not matched."
-    error = pred - gt
-    abs_error = torch.abs(error)
-    
-    smooth_sqrt_abs_error = smooth_item_l0_5(abs_error, beta)
-    loss = torch.mean(smooth_sqrt_abs_error)
-    return loss
+    return _smooth_l0_5_kernel(pred - gt, beta, dim)
 
 class SSIM(nn.Module):
     """Layer to compute the SSIM loss between a pair of images
+
+    Works on (..., C, H, W) images, x and y broadcast against each other so one reference can be compared to
+    several warped views at once. The local statistics are pooled together in a single 3x3 average pooling.
     """
     def __init__(self):
         super(SSIM, self).__init__()
-        self.mu_x_pool   = nn.AvgPool2d(3, 1)
-        self.mu_y_pool   = nn.AvgPool2d(3, 1)
-        self.sig_x_pool  = nn.AvgPool2d(3, 1)
-        self.sig_y_pool  = nn.AvgPool2d(3, 1)
-        self.sig_xy_pool = nn.AvgPool2d(3, 1)
-        self.mask_pool = nn.AvgPool2d(3, 1)
+        self.pool = nn.AvgPool2d(3, 1)
         self.C1 = 0.01 ** 2
         self.C2 = 0.03 ** 2
 
     def forward(self, x, y, mask):
-        x = x.permute(0, 3, 1, 2)  # [B, H, W, C] --> [B, C, H, W]
-        y = y.permute(0, 3, 1, 2)
-        mask = mask.permute(0, 3, 1, 2)
-        mu_x = self.mu_x_pool(x)
-        mu_y = self.mu_y_pool(y)
-        sigma_x  = self.sig_x_pool(x ** 2) - mu_x ** 2
-        sigma_y  = self.sig_y_pool(y ** 2) - mu_y ** 2
-        sigma_xy = self.sig_xy_pool(x * y) - mu_x * mu_y
+        """
+        :param x: (..., C, H, W)
+        :param y: (..., C, H, W)
+        :param mask: (..., 1, H, W)
+        :return: (..., C, H - 2, W - 2)
+        """
+        x, y = torch.broadcast_tensors(x, y)
+        *lead, c, h, w = y.shape
+        mask = mask.expand(*lead, 1, h, w)
+        stats = torch.cat([x, y, x * x, y * y, x * y, mask], dim=-3)
+        stats = self.pool(stats.reshape(-1, 5 * c + 1, h, w))
+        stats = stats.view(*lead, 5 * c + 1, h - 2, w - 2)
+        mu_x, mu_y, e_xx, e_yy, e_xy = torch.split(stats[..., :5 * c, :, :], c, dim=-3)
+        SSIM_mask = stats[..., 5 * c:, :, :]
+
+        sigma_x  = e_xx - mu_x ** 2
+        sigma_y  = e_yy - mu_y ** 2
+        sigma_xy = e_xy - mu_x * mu_y
         SSIM_n = (2 * mu_x * mu_y + self.C1) * (2 * sigma_xy + self.C2)
-        SSIM_d = (mu_x ** 2 + mu_y ** 2 + self.C1) * (sigma_x + sigma_y + self.C2) 
-  
-        SSIM_mask = self.mask_pool(mask)
-
-        output = SSIM_mask * (torch.clamp((1 - SSIM_n / SSIM_d) / 2, 0, 1) + 1e-6)
+        SSIM_d = (mu_x ** 2 + mu_y ** 2 + self.C1) * (sigma_x + sigma_y + self.C2)
 
-        if torch.sum(SSIM_mask.type(torch.float32)) == 0:
-            output = torch.zeros_like(output,dtype=torch.float32,device=output.device)
-        return output.permute(0, 2, 3, 1)  # [B, C, H, W] --> [B, H, W, C]
+        # an empty mask pools to 0 and zeroes the output by itself
+        return SSIM_mask * (torch.clamp((1 - SSIM_n / SSIM_d) / 2, 0, 1) + 1e-6)
 
 
 def gradient_x(img):
@@ -392,202 +500,59 @@ def depth_smoothness(depth, img,lambda_wt=1):
     return torch.mean(torch.abs(smoothness_x)) + torch.mean(torch.abs(smoothness_y))
 
 
-def compute_reconstr_loss_l0_5(warped, ref, mask, simple=True):
-    if simple:
-        return smooth_l0_5(warped*mask, ref*mask)
-    else:
-        alpha = 0.5
-        ref_dx, ref_dy = gradient(ref * mask)
-        warped_dx, warped_dy = gradient(warped * mask)
-        photo_loss = smooth_l0_5(warped*mask, ref*mask)
-        grad_loss = smooth_l0_5(warped_dx, ref_dx) + \
-                    smooth_l0_5(warped_dy, ref_dy)
-        return (1 - alpha) * photo_loss + alpha * grad_loss
+def compute_reconstr_loss_l0_5_views(warped, ref, mask):
+    """
+    smooth l0.5 photometric and gradient reconstruction loss of every source view at once
+    :param warped: (b, v, c, h, w) source images warped to the reference view
+    :param ref: (b, 1, c, h, w)
+    :param mask: (b, v, 1, h, w)
+    :return: (v,)
+    """
+    alpha = 0.5
+    dims = (0, 2, 3, 4)
+    warped, ref = warped * mask, ref * mask
+    photo_loss = smooth_l0_5(warped, ref, dim=dims)
+    grad_loss = smooth_l0_5(warped[..., :, 1:] - warped[..., :, :-1], ref[..., :, 1:] - ref[..., :, :-1], dim=dims) + \
+                smooth_l0_5(warped[..., 1:, :] - warped[..., :-1, :], ref[..., 1:, :] - ref[..., :-1, :], dim=dims)
+    return (1 - alpha) * photo_loss + alpha * grad_loss
+
+
+@functools.lru_cache(maxsize=8)
+def _pixel_grid(height, width, device):
+    """ [3, height * width] homogeneous pixel coordinates, cached per size and device """
+    y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=device),
+                           torch.arange(0, width, dtype=torch.float32, device=device)])
+    x, y = x.reshape(-1), y.reshape(-1)
+    return torch.stack((x, y, torch.ones_like(x)))
+
+
+def inverse_warping_views(imgs, proj, depth):
+    """
+    warp all the source views to the reference view with its depth
+    :param imgs: (b, v, c, h, w) source images
+    :param proj: (b, v, 4, 4) projections of the reference camera coordinates (pixel * depth) to the source pixels
+    :param depth: (b, h, w) reference depth
+    :return: warped images (b, v, c, h, w) and their validity mask (b, v, 1, h, w)
+    """
+    batch_size, num_views, channels, img_height, img_width = imgs.shape
+    grid = _pixel_grid(img_height, img_width, imgs.device)  # [3, height * width]
+    cam_coords = grid.unsqueeze(0) * depth.reshape(batch_size, 1, img_height * img_width)  # [B, 3, height * width]
+    pcoords = torch.matmul(proj[:, :, :3, :3], cam_coords.unsqueeze(1)) + proj[:, :, :3, 3:4]  # [B, V, 3, height * width]
+    x = pcoords[:, :, 0] / (pcoords[:, :, 2] + 1e-10)
+    y = pcoords[:, :, 1] / (pcoords[:, :, 2] + 1e-10)
+
+    # the four neighbours of valid pixels are inside the image, except the row below the last one
+    mask = (x >= 0) & (x < img_width - 1) & (y >= 0) & (y < img_height)
+    mask = mask.float().reshape(batch_size, num_views, 1, img_height, img_width)
+
+    # neighbours outside of the image are clamped to its border
+    x = x / ((img_width - 1) / 2) - 1
+    y = y / ((img_height - 1) / 2) - 1
+    grid = torch.stack((x, y), dim=-1).reshape(batch_size * num_views, img_height, img_width, 2)
+    warped = F.grid_sample(imgs.reshape(batch_size * num_views, channels, img_height, img_width).float(), grid,
+                           mode='bilinear', padding_mode='border', align_corners=True)
+    return warped.reshape(batch_size, num_views, channels, img_height, img_width), mask
 
-    
-def inverse_warping(img, left_cam, right_cam, depth):
-    # img: [batch_size, height, width, channels]
-    # cameras (K, R, t)
-    R_left = left_cam[:, 0:1, 0:3, 0:3]  # [B, 1, 3, 3]
-    R_right = right_cam[:, 0:1, 0:3, 0:3]  # [B, 1, 3, 3]
-    t_left = left_cam[:, 0:1, 0:3, 3:4]  # [B, 1, 3, 1]
-    t_right = right_cam[:, 0:1, 0:3, 3:4]  # [B, 1, 3, 1]
-    K_left = left_cam[:, 1:2, 0:3, 0:3]  # [B, 1, 3, 3]
-    K_right = right_cam[:, 1:2, 0:3, 0:3]  # [B, 1, 3, 3]
-
-    K_left = K_left.squeeze(1)  # [B, 3, 3]
-    K_left_inv = torch.inverse(K_left)  # [B, 3, 3]
-    R_left_trans = R_left.squeeze(1).permute(0, 2, 1)  # [B, 3, 3]
-    R_right_trans = R_right.squeeze(1).permute(0, 2, 1)  # [B, 3, 3]
-
-    R_left = R_left.squeeze(1)
-    t_left = t_left.squeeze(1)
-    R_right = R_right.squeeze(1)
-    t_right = t_right.squeeze(1)
-
-    # estimate egomotion by inverse composing R1,R2 and t1,t2
-    R_rel = torch.matmul(R_right, R_left_trans)  # [B, 3, 3]    
-    t_rel = t_right - torch.matmul(R_rel, t_left)  # [B, 3, 1]  
-    # now convert R and t to transform mat, as in SFMlearner
-    batch_size = R_left.shape[0]
-    filler = torch.Tensor([0.0, 0.0, 0.0, 1.0]).cuda().reshape(1, 1, 4)  # [1, 1, 4]
-    filler = filler.repeat(batch_size, 1, 1)  # [B, 1, 4]
-    transform_mat = torch.cat([R_rel, t_rel], dim=2)  # [B, 3, 4]
-    transform_mat = torch.cat([transform_mat.float(), filler.float()], dim=1)  # [B, 4, 4]
-    batch_size, img_height, img_width, _ = img.shape
-    depth = depth.reshape(batch_size, 1, img_height * img_width)  # [batch_size, 1, height * width]
-
-    grid = _meshgrid_abs(img_height, img_width)  # [3, height * width]
-    grid = grid.unsqueeze(0).repeat(batch_size, 1, 1)  # [batch_size, 3, height * width]
-    cam_coords = _pixel2cam(depth, grid, K_left_inv)  # [batch_size, 3, height * width]
-    ones = torch.ones([batch_size, 1, img_height * img_width]).cuda()  # [batch_size, 1, height * width]
-    cam_coords_hom = torch.cat([cam_coords, ones], dim=1)  # [batch_size, 4, height * width]
-
-    # Get projection matrix for target camera frame to source pixel frame
-    hom_filler = torch.Tensor([0.0, 0.0, 0.0, 1.0]).cuda().reshape(1, 1, 4)  # [1, 1, 4]
-    hom_filler = hom_filler.repeat(batch_size, 1, 1)  # [B, 1, 4]
-    intrinsic_mat_hom = torch.cat([K_left.float(), torch.zeros([batch_size, 3, 1]).cuda()], dim=2)  # [B, 3, 4]
-    intrinsic_mat_hom = torch.cat([intrinsic_mat_hom, hom_filler], dim=1)  # [B, 4, 4]
-    proj_target_cam_to_source_pixel = torch.matmul(intrinsic_mat_hom, transform_mat)  # [B, 4, 4]
-    source_pixel_coords = _cam2pixel(cam_coords_hom, proj_target_cam_to_source_pixel)  # [batch_size, 2, height * width]
-    source_pixel_coords = source_pixel_coords.reshape(batch_size, 2, img_height, img_width)   # [batch_size, 2, height, width]
-    source_pixel_coords = source_pixel_coords.permute(0, 2, 3, 1)  # [batch_size, height, width, 2]
-    warped_right, mask = _spatial_transformer(img, source_pixel_coords)
-    return warped_right, mask
-
-
-def _meshgrid_abs(height, width):
-    """Meshgrid in the absolute coordinates."""
-    x_t = torch.matmul(
-        torch.ones([height, 1]),
-        torch.linspace(-1.0, 1.0, width).unsqueeze(1).permute(1, 0)
-    )  # [height, width]
-    y_t = torch.matmul(
-        torch.linspace(-1.0, 1.0, height).unsqueeze(1),
-        torch.ones([1, width])
-    )
-    x_t = (x_t + 1.0) * 0.5 * (width - 1)
-    y_t = (y_t + 1.0) * 0.5 * (height - 1)
-    x_t_flat = x_t.reshape(1, -1)
-    y_t_flat = y_t.reshape(1, -1)
-    ones = torch.ones_like(x_t_flat)
-    grid = torch.cat([x_t_flat, y_t_flat, ones], dim=0)  # [3, height * width]
-    # return grid.to(device)
-    return grid.cuda()
-
-
-def _pixel2cam(depth, pixel_coords, intrinsic_mat_inv):
-    """Transform coordinates in the pixel frame to the camera frame."""
-    cam_coords = torch.matmul(intrinsic_mat_inv.float(), pixel_coords.float()) * depth.float()
-    return cam_coords
-
-
-def _cam2pixel(cam_coords, proj_c2p):
-    """Transform coordinates in the camera frame to the pixel frame."""
-    pcoords = torch.matmul(proj_c2p, cam_coords)  # [batch_size, 4, height * width]
-    x = pcoords[:, 0:1, :]  # [batch_size, 1, height * width]
-    y = pcoords[:, 1:2, :]  # [batch_size, 1, height * width]
-    z = pcoords[:, 2:3, :]  # [batch_size, 1, height * width]
-    x_norm = x / (z + 1e-10)
-    y_norm = y / (z + 1e-10)
-    pixel_coords = torch.cat([x_norm, y_norm], dim=1)
-    return pixel_coords  # [batch_size, 2, height * width]
-
-
-def _spatial_transformer(img, coords):
-    """A wrapper over binlinear_sampler(), taking absolute coords as input."""
-    # img: [B, H, W, C]
-    img_height = img.shape[1]
-    img_width = img.shape[2]
-    px = coords[:, :, :, :1]  # [batch_size, height, width, 1]
-    py = coords[:, :, :, 1:]  # [batch_size, height, width, 1]
-    # Normalize coordinates to [-1, 1] to send to _bilinear_sampler.
-    px = px / (img_width - 1) * 2.0 - 1.0  # [batch_size, height, width, 1]
-    py = py / (img_height - 1) * 2.0 - 1.0  # [batch_size, height, width, 1]
-    output_img, mask = _bilinear_sample(img, px, py)
-    return output_img, mask
-
-
-def _bilinear_sample(im, x, y, name='bilinear_sampler'):
-    """Perform bilinear sampling on im given list of x, y coordinates.
-    Implements the differentiable sampling mechanism with bilinear kernel
-    in https://arxiv.org/abs/1506.02025.
-    x,y are tensors specifying normalized coordinates [-1, 1] to be sampled on im.
-    For example, (-1, -1) in (x, y) corresponds to pixel location (0, 0) in im,
-    and (1, 1) in (x, y) corresponds to the bottom right pixel in im.
-    Args:
-        im: Batch of images with shape [B, h, w, channels].
-        x: Tensor of normalized x coordinates in [-1, 1], with shape [B, h, w, 1].
-        y: Tensor of normalized y coordinates in [-1, 1], with shape [B, h, w, 1].
-        name: Name scope for ops.
-    Returns:
-        Sampled image with shape [B, h, w, channels].
-        Principled mask with shape [B, h, w, 1], dtype:float32.  A value of 1.0
-        in the mask indicates that the corresponding coordinate in the sampled
-        image is valid.
-      """
-    x = x.reshape(-1)  # [batch_size * height * width]
-    y = y.reshape(-1)  # [batch_size * height * width]
-
-    # Constants.
-    batch_size, height, width, channels = im.shape
-
-    x, y = x.float(), y.float()
-    max_y = int(height - 1)
-    max_x = int(width - 1)
-
-    # Scale indices from [-1, 1] to [0, width - 1] or [0, height - 1].
-    x = (x + 1.0) * (width - 1.0) / 2.0
-    y = (y + 1.0) * (height - 1.0) / 2.0
-
-    # Compute the coordinates of the 4 pixels to sample from.
-    x0 = torch.floor(x).int()
-    x1 = x0 + 1
-    y0 = torch.floor(y).int()
-    y1 = y0 + 1
-
-    mask = (x0 >= 0) & (x1 <= max_x) & (y0 >= 0) & (y0 <= max_y)
-    mask = mask.float()
-
-    x0 = torch.clamp(x0, 0, max_x)
-    x1 = torch.clamp(x1, 0, max_x)
-    y0 = torch.clamp(y0, 0, max_y)
-    y1 = torch.clamp(y1, 0, max_y)
-    dim2 = width
-    dim1 = width * height
-
-    # Create base index.
-    base = torch.arange(batch_size) * dim1
-    base = base.reshape(-1, 1)
-    base = base.repeat(1, height * width)
-    base = base.reshape(-1)  # [batch_size * height * width]
-    # base = base.long().to(device)
-    base = base.long().cuda()
-
-    base_y0 = base + y0.long() * dim2
-    base_y1 = base + y1.long() * dim2
-    idx_a = base_y0 + x0.long()
-    idx_b = base_y1 + x0.long()
-    idx_c = base_y0 + x1.long()
-    idx_d = base_y1 + x1.long()
-
-    # Use indices to lookup pixels in the flat image and restore channels dim.
-    im_flat = im.reshape(-1, channels).float()  # [batch_size * height * width, channels]
-    pixel_a = im_flat[idx_a]
-    pixel_b = im_flat[idx_b]
-    pixel_c = im_flat[idx_c]
-    pixel_d = im_flat[idx_d]
-
-    wa = (x1.float() - x) * (y1.float() - y)
-    wb = (x1.float() - x) * (1.0 - (y1.float() - y))
-    wc = (1.0 - (x1.float() - x)) * (y1.float() - y)
-    wd = (1.0 - (x1.float() - x)) * (1.0 - (y1.float() - y))
-    wa, wb, wc, wd = wa.unsqueeze(1), wb.unsqueeze(1), wc.unsqueeze(1), wd.unsqueeze(1)
-
-    output = wa * pixel_a + wb * pixel_b + wc * pixel_c + wd * pixel_d
-    output = output.reshape(batch_size, height, width, channels)
-    mask = mask.reshape(batch_size, height, width, 1)
-    return output, mask
 
 def adjust_w_icc(epoch_idx, w_icc, max_w_icc):
     if epoch_idx >= 2 - 1:   # 2